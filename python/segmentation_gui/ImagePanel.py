@@ -58,6 +58,7 @@ class ImagePanel(QtGui.QLabel):
         tp.btnCancelBug.clicked.connect(self.cancelNewSpecimin)
         tp.btnSelectTemplate.clicked.connect(self.selectNewTemplate)
         tp.btnSelectBox.clicked.connect(self.toggleSelectBox)
+        tp.btnSegmentAll.clicked.connect(self.segmentAll)
 
     # --------------------------------
     # Slots
@@ -107,6 +108,11 @@ class ImagePanel(QtGui.QLabel):
             self.data.cancelBox()
             self.repaint()
 
+    def segmentAll(self):
+        if self._paneMode == self.Nothing:
+            self.data.segmentAll()
+            self.repaint()
+
     def toggleSelectBox(self):
         if self._paneMode == self.Nothing:
             self._paneMode = self.BoxSelect
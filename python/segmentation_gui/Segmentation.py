@@ -23,8 +23,13 @@ from numpy import *
 from pylab import *
 from scipy.ndimage import filters
 from math import *
+from multiprocessing.pool import ThreadPool
+from numpy.lib.format import open_memmap
+import hashlib
 import logging
 import random
+import numpy
+import os
 
 class SegmentationData:
     _imageFilename = ""
@@ -43,6 +48,26 @@ class SegmentationData:
     stepy = 15
     scales = [0.75, 1.0, 1.25, 1.5]
 
+    # Filter bank of the feature stack, as (filter, sigma, axis). The sobel
+    # filters are taken of the gaussian with the same sigma
+    featureBank = [('gaussian', 2, None), ('gaussian', 3, None),
+                   ('gaussian', 4, None), ('gaussian', 5, None),
+                   ('laplace', 2, None), ('laplace', 3, None),
+                   ('laplace', 4, None), ('laplace', 5, None),
+                   ('sobel', 4, 0), ('sobel', 5, 0),
+                   ('sobel', 4, 1), ('sobel', 5, 1)]
+    # The features are computed on tiles of tileSize x tileSize pixels, and
+    # read by segmentAll in bands of bandHeight rows
+    tileSize = 1024
+    bandHeight = 256
+
+    # Where the feature file goes when the image folder is read only
+    cacheDir = os.path.join(os.path.expanduser("~"), ".segmentation_cache")
+
+    # Automatic segmentation thresholds, as in random_template_scale.m
+    peakThreshold = 0.1
+    rankThreshold = 0.88
+
     def __init__(self, logfile=None):
         if logfile:
             logging.basicConfig(filename=logfile, level=logging.DEBUG, format="- %(message)s")
@@ -90,9 +115,11 @@ class SegmentationData:
             rx = int(random.randrange(-w,w))
             ry = int(random.randrange(-h,h))
             self._templatePositions.append((rx,ry))
-            self._template.append(self._features[ry+y1+h,rx+x1+w,:])
 
-        self._template = dstack(self._template)
+        # pcount x features array of the template samples
+        self._templatePositions = array(self._templatePositions)
+        (px, py) = self._templatePositions.T
+        self._template = self.sampleFeatures(py+y1+h, px+x1+w).T
 
     def loadImage(self, fname):
         self._imageFilename = fname
@@ -101,28 +128,120 @@ class SegmentationData:
         self._currentBox = None
         logging.info("Load image %s" % fname)
 
-        self._image = array(Image.open(fname).convert('L'), dtype='f')/255
-        (h,w) = shape(self._image)
+        key = self.featureKey(fname)
+        name = "%s.%s.features.npy" % (os.path.basename(fname), key[:16])
+        paths = [os.path.join(os.path.dirname(fname), name),
+                 os.path.join(self.cacheDir, name)]
+        found = [path for path in paths if os.path.exists(path)]
+        if found:
+            self._features = open_memmap(found[0], mode='r')
+            logging.info("Loaded features from %s" % found[0])
+        else:
+            gray = Image.open(fname).convert('L')
+            self._features = self.computeFeatures(gray, paths)
+
+        (_,h,w) = self._features.shape
         self._imageSize = (w,h)
-        im1 = filters.gaussian_filter(self._image, 2)
-        im2 = filters.gaussian_filter(self._image, 3)
-        im4 = filters.gaussian_filter(self._image, 4)
-        im8 = filters.gaussian_filter(self._image, 5)
-
-        features = []
-        features.append(im1)
-        features.append(im2)
-        features.append(im4)
-        features.append(im8)
-        features.append(filters.gaussian_laplace(self._image, 2))
-        features.append(filters.gaussian_laplace(self._image, 3))
-        features.append(filters.gaussian_laplace(self._image, 4))
-        features.append(filters.gaussian_laplace(self._image, 5))
-        features.append(filters.sobel(im4, 0))
-        features.append(filters.sobel(im8, 0))
-        features.append(filters.sobel(im4, 1))
-        features.append(filters.sobel(im8, 1))
-        self._features = dstack(features)
+
+    def featureKey(self, fname):
+        # Hash of the image file and the filter bank, so the features are
+        # recomputed when either changes
+        sha = hashlib.sha1(repr(self.featureBank).encode())
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def computeFeatures(self, gray, paths):
+        # Compute the features one tile at a time, in a pool of threads. Each
+        # tile is filtered with a halo of the neighbouring pixels, wide enough
+        # for the largest filter, and only its inside is written to the
+        # features x height x width file. The features are then the same as
+        # filtering the whole image at once, and the memory used only depends
+        # on the tile size, besides the 8-bit gray image that PIL decodes
+        # whole. The scipy filters release the GIL, so the tiles run on every
+        # core
+        (w,h) = gray.size
+        (tmp, path, features) = self.createFeatureFile(
+            paths, (len(self.featureBank), h, w))
+        halo = self.featureHalo()
+        logging.debug("Computing features in %dx%d tiles with a %d pixel halo"
+            % (self.tileSize, self.tileSize, halo))
+
+        # The memmap is passed as a default argument rather than closed over,
+        # so it can be deleted below to close the file
+        def run(tile, features=features):
+            (x0,y0,x1,y1) = tile
+            (hx0,hy0) = (max(x0-halo, 0), max(y0-halo, 0))
+            (hx1,hy1) = (min(x1+halo, w), min(y1+halo, h))
+            image = array(gray.crop((hx0,hy0,hx1,hy1)), dtype='f')/255
+            out = self.filterTile(image)
+            features[:, y0:y1, x0:x1] = out[:, y0-hy0:y1-hy0, x0-hx0:x1-hx0]
+
+        tiles = [(x0, y0, min(x0+self.tileSize, w), min(y0+self.tileSize, h))
+                 for y0 in range(0, h, self.tileSize)
+                 for x0 in range(0, w, self.tileSize)]
+        pool = ThreadPool()
+        try:
+            pool.map(run, tiles, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Only give the file its final name once it is complete, so an
+        # interrupted run never leaves a broken feature file
+        features.flush()
+        del run, features
+        os.rename(tmp, path)
+        logging.info("Saved features to %s" % path)
+
+        return open_memmap(path, mode='r')
+
+    def featureHalo(self):
+        # The gaussian filters reach 4 sigma (the scipy default truncation),
+        # and the sobels reach one more pixel into their gaussian
+        sigma = max([sigma for (_, sigma, _) in self.featureBank])
+        return int(4.0*sigma + 0.5) + 1
+
+    def filterTile(self, image):
+        # Run the filter bank on one tile, as a features x height x width
+        # array. The sobels are taken of the gaussians already computed
+        out = empty((len(self.featureBank),) + shape(image), dtype=float32)
+        gaussians = dict()
+        for (i, (kind, sigma, axis)) in enumerate(self.featureBank):
+            if kind == 'gaussian':
+                filters.gaussian_filter(image, sigma, output=out[i])
+                gaussians[sigma] = i
+            elif kind == 'laplace':
+                filters.gaussian_laplace(image, sigma, output=out[i])
+            else:
+                filters.sobel(out[gaussians[sigma]], axis, output=out[i])
+        return out
+
+    def createFeatureFile(self, paths, fshape):
+        # Create the float32 feature file at the first of the paths that can
+        # be written to. Returns (temporary path, final path, memmap)
+        for path in paths:
+            try:
+                folder = os.path.dirname(path)
+                if folder != "" and not os.path.isdir(folder):
+                    os.makedirs(folder)
+                tmp = path + ".tmp"
+                features = open_memmap(tmp, mode='w+', dtype=float32,
+                                       shape=fshape)
+                return (tmp, path, features)
+            except (IOError, OSError) as e:
+                logging.warning("Cannot write features to %s: %s" % (path, e))
+
+        raise IOError("No writable location for the features of the image")
+
+    def sampleFeatures(self, sy, sx):
+        # Features at the points (sy,sx), as a features x points array. Only
+        # the rows and columns around the points are read from the file
+        (y0, y1) = (int(sy.min()), int(sy.max())+1)
+        (x0, x1) = (int(sx.min()), int(sx.max())+1)
+        window = asarray(self._features[:, y0:y1, x0:x1])
+        return window[:, sy-y0, sx-x0]
 
     def saveCSV(self, fname):
         f = open(fname, 'w')
@@ -148,24 +267,137 @@ class SegmentationData:
         tw = int((x2-x1)/2)
         th = int((y2-y1)/2)
         (width, height) = self._imageSize
-        scores = []
-        for iy in range(-th/2, th/2+self.stepy, self.stepy):
-            for ix in range(-tw/2, tw/2+self.stepx, self.stepx):
-                for s in self.scales:
-                    if not ((mx+ix-tw*s < 0) or (my+iy-th*s < 0) or
-                            (mx+ix+tw*s > width) or (my+iy+th*s > height)):
-                        target = []
-                        for i in range(self.pcount):
-                            (px,py) = self._templatePositions[i]
-                            target.append(self._features[my+iy+int(py*s),mx+ix+int(px*s),:])
-                        target = dstack(target)
-                        diff = target - self._template
-                        scores.append((sum(diff*diff), s,  mx+ix, my+iy))
-        (_, s, bestx, besty) = min(scores)
+
+        # Every (offset, scale) candidate whose box fits in the image
+        iy = arange(-th//2, th//2+self.stepy, self.stepy)
+        ix = arange(-tw//2, tw//2+self.stepx, self.stepx)
+        (cy, cx, cs) = meshgrid(my+iy, mx+ix, self.scales, indexing='ij')
+        valid = ((cx-tw*cs >= 0) & (cy-th*cs >= 0) &
+                 (cx+tw*cs <= width) & (cy+th*cs <= height))
+        (cx, cy, cs) = (cx[valid], cy[valid], cs[valid])
+        if len(cx) == 0:
+            logging.debug("No box fits around the click")
+            return
+
+        scores = self.templateScores(cx, cy, cs)
+        best = argmin(scores)
+        (s, bestx, besty) = (float(cs[best]), float(cx[best]),
+                             float(cy[best]))
         self._currentBox = (bestx-tw*s, besty-th*s, bestx+tw*s, besty+th*s)
         logging.debug("Box placed automatically at (%d, %d, %d, %d)"
             % self._currentBox)
 
+    def templateScores(self, cx, cy, cs):
+        # Sum of squared differences between the template and the features
+        # sampled at the template positions around each candidate centre
+        # (cx,cy) scaled by cs. All the samples are gathered at once, as a
+        # features x candidates x pcount array
+        (px, py) = self._templatePositions.T
+        sx = (cx[:,newaxis] + fix(px*cs[:,newaxis])).astype(int)
+        sy = (cy[:,newaxis] + fix(py*cs[:,newaxis])).astype(int)
+        diff = self.sampleFeatures(sy, sx) - self._template.T[:,newaxis,:]
+        return einsum('kij,kij->i', diff, diff)
+
+    def segmentAll(self, threshold=None):
+        # Place a box on every specimen that matches the template, like
+        # matlab/random_template_scale.m. The template is scored on a grid of
+        # centres over the whole image at every scale, and the local maxima
+        # over position and scale are placed from best to worst, skipping
+        # those that overlap a box that is already there, so running it again
+        # only adds the specimens that are still missing. Returns the newly
+        # placed boxes as (score, box) from best to worst
+        if threshold == None:
+            threshold = self.rankThreshold
+        (x1,y1,x2,y2) = self.templateBox()
+        tw = int((x2-x1)/2)
+        th = int((y2-y1)/2)
+        (width, height) = self._imageSize
+        logging.info("Segment all specemins with threshold %f" % threshold)
+
+        xs = arange(1, int(round(float(width)/self.stepx))+1)*self.stepx
+        ys = arange(1, int(round(float(height)/self.stepy))+1)*self.stepy
+        maxscore = float(self.pcount*self._features.shape[0])
+        scores = self.gridScores(xs, ys, tw, th, maxscore)
+        scores = numpy.exp(-(scores*scores)/((maxscore/10)**2))
+
+        # Local maxima in a 5x5x5 neighbourhood of position and scale
+        peaks = filters.maximum_filter(scores, size=5, mode='nearest')
+        (iy, ix, ik) = nonzero((scores == peaks) &
+                               (scores >= self.peakThreshold))
+        order = argsort(-scores[iy, ix, ik], kind='mergesort')
+
+        # Boxes as (centre x, centre y, half width, half height), starting
+        # with the template and the boxes already placed
+        existing = [box for (_, box) in self._boxes] + [self._templateBox]
+        if self._currentBox != None:
+            existing.append(self._currentBox)
+        taken = [((bx1+bx2)/2.0, (by1+by2)/2.0,
+                  abs(bx2-bx1)/2.0, abs(by2-by1)/2.0)
+                 for (bx1,by1,bx2,by2) in existing]
+
+        ranked = []
+        for i in order:
+            score = float(scores[iy[i], ix[i], ik[i]])
+            if score < threshold:
+                break
+            (cx, cy, s) = (float(xs[ix[i]]), float(ys[iy[i]]),
+                           self.scales[ik[i]])
+            (hw, hh) = (tw*s, th*s)
+            hit = False
+            for (qx, qy, qw, qh) in taken:
+                if abs(cx-qx) <= (hw if hw > qw else qw) and \
+                        abs(cy-qy) <= (hh if hh > qh else qh):
+                    hit = True
+                    break
+            if not hit:
+                taken.append((cx, cy, hw, hh))
+                box = (cx-hw, cy-hh, cx+hw, cy+hh)
+                self._boxes.append((self._boxCount, box))
+                self._boxCount += 1
+                ranked.append((score, box))
+        logging.debug("Placed %d boxes automatically" % len(ranked))
+
+        return ranked
+
+    def gridScores(self, xs, ys, tw, th, maxscore):
+        # Sum of squared differences of the template at every scale centred
+        # on every point of the grid xs by ys, as a ys x xs x scales array,
+        # or maxscore where the box does not fit in the image. The features
+        # are read one band of rows at a time, with a halo for the height of
+        # the template, and every position is scored while the band is in
+        # memory. The grid is regular, so the samples of one template
+        # position at every centre of a band are a strided slice of it
+        (width, height) = self._imageSize
+        scores = maxscore*ones((len(ys), len(xs), len(self.scales)))
+        (px, py) = self._templatePositions.T
+        offsets = [(fix(px*s).astype(int), fix(py*s).astype(int))
+                   for s in self.scales]
+        halo = int(max([abs(dy).max() for (_, dy) in offsets]))
+        rows = max(self.bandHeight//self.stepy, 1)
+
+        for j in range(0, len(ys), rows):
+            band = ys[j:j+rows]
+            (r0, r1) = (max(band[0]-halo, 0), min(band[-1]+halo+1, height))
+            block = asarray(self._features[:, r0:r1, :])
+            for (k, s) in enumerate(self.scales):
+                vx = nonzero((xs-tw*s >= 0) & (xs+tw*s <= width))[0]
+                vy = nonzero((band-th*s >= 0) & (band+th*s <= height))[0]
+                if len(vx) == 0 or len(vy) == 0:
+                    continue
+
+                (ax, bx) = (xs[vx[0]], xs[vx[-1]]+1)
+                (ay, by) = (band[vy[0]]-r0, band[vy[-1]]-r0+1)
+                total = zeros((len(vy), len(vx)))
+                (dxs, dys) = offsets[k]
+                for (dx, dy, t) in zip(dxs, dys, self._template):
+                    diff = (block[:, ay+dy:by+dy:self.stepy,
+                                  ax+dx:bx+dx:self.stepx] -
+                            t[:,newaxis,newaxis])
+                    total += einsum('kij,kij->ij', diff, diff)
+                scores[j+vy[0]:j+vy[-1]+1, vx[0]:vx[-1]+1, k] = total
+
+        return scores
+
     def chooseBox(self,pos):
         (mx,my) = pos
 
@@ -52,6 +52,11 @@ class ToolPanel(QtGui.QFrame):
         self.btnCancelBug.setStatusTip("Cancel bug selection")
         self.btnCancelBug.setEnabled(False)
 
+        self.btnSegmentAll = QtGui.QPushButton("Segment All")
+        self.btnSegmentAll.setMinimumHeight(50)
+        self.btnSegmentAll.setStatusTip("Place a box on every specimen like the template")
+        self.btnSegmentAll.setEnabled(False)
+
         self.btnSelectBox = QtGui.QPushButton("Select Exsisting Box")
         self.btnSelectBox.setMinimumHeight(50)
 
@@ -67,9 +72,10 @@ class ToolPanel(QtGui.QFrame):
         content.addWidget(self.btnSelectTemplate, 1, 0, 1, 2)
         content.addWidget(self.btnNextBug, 2, 0)
         content.addWidget(self.btnCancelBug, 2, 1)
-        content.addWidget(self.btnSelectBox, 3, 0, 1, 2)
-        content.addWidget(self.btnSaveBoxes, 4, 0, 1, 2)
-        content.addWidget(frmEmpty, 5, 0, 1, 2)
+        content.addWidget(self.btnSegmentAll, 3, 0, 1, 2)
+        content.addWidget(self.btnSelectBox, 4, 0, 1, 2)
+        content.addWidget(self.btnSaveBoxes, 5, 0, 1, 2)
+        content.addWidget(frmEmpty, 6, 0, 1, 2)
 
         # Finish up pane
         self.setLayout(content)
@@ -107,9 +113,11 @@ class ToolPanel(QtGui.QFrame):
             self.btnNextBug.setEnabled(False)
             self.btnCancelBug.setEnabled(False)
             self.btnSelectBox.setEnabled(False)
+            self.btnSegmentAll.setEnabled(False)
         elif ev == "TemplateSelected":
             self.btnSelectTemplate.setText("Reset Template")
             self.btnNextBug.setEnabled(True)
+            self.btnSegmentAll.setEnabled(True)
             self.btnSelectBox.setEnabled(True)
 
     def bugSelection(self, result):
@@ -122,11 +130,13 @@ class ToolPanel(QtGui.QFrame):
             self.btnNextBug.setText("Select\nBug")
             self.btnSelectTemplate.setEnabled(True)
             self.btnSelectBox.setEnabled(True)
+            self.btnSegmentAll.setEnabled(True)
         elif result == "Start":
             self.btnCancelBug.setEnabled(True)
             self.btnNextBug.setText("Confirm\nBug")
             self.btnSelectTemplate.setEnabled(False)
             self.btnSelectBox.setEnabled(False)
+            self.btnSegmentAll.setEnabled(False)
             self.btnNextBug.setEnabled(False)
 
     def boxSelection(self, result):
@@ -135,10 +145,12 @@ class ToolPanel(QtGui.QFrame):
             self.btnCancelBug.setText("Delete\nBox")
             self.btnSelectTemplate.setEnabled(False)
             self.btnNextBug.setEnabled(False)
+            self.btnSegmentAll.setEnabled(False)
             self.btnCancelBug.setEnabled(True)
         elif result == "BoxSelectOff":
             self.btnSelectBox.setText("Select Exsisting Box")
             self.btnCancelBug.setText("Cancel\nSelection")
             self.btnSelectTemplate.setEnabled(True)
             self.btnNextBug.setEnabled(True)
+            self.btnSegmentAll.setEnabled(True)
             self.btnCancelBug.setEnabled(False)
@@ -0,0 +1,138 @@
+# Checks that the image features computed tile by tile are the same as
+# filtering the whole image at once, on random images
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# segmentation project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from PIL import Image
+from numpy import *
+from scipy.ndimage import filters
+from Segmentation import SegmentationData
+import os
+import shutil
+import sys
+import tempfile
+
+TRIALS = 20
+
+# Tile sizes to check, smaller and larger than the halo, ones that do not
+# divide the image, and one tile for the whole image
+TILE_SIZES = [8, 21, 32, 50, 97, 1024]
+
+
+def referenceFeatures(image, featureBank):
+    # The features as they were computed before the tiles, with each filter
+    # of the bank run on the whole image. The sobels are taken of the
+    # gaussians once those are done
+    features = empty((len(featureBank),) + shape(image), dtype=float32)
+    gaussians = dict((sigma, i) for (i, (kind, sigma, _))
+                     in enumerate(featureBank) if kind == 'gaussian')
+    for (i, (kind, sigma, _)) in enumerate(featureBank):
+        if kind == 'gaussian':
+            features[i] = filters.gaussian_filter(image, sigma, output=float32)
+        elif kind == 'laplace':
+            features[i] = filters.gaussian_laplace(image, sigma,
+                                                   output=float32)
+    for (i, (kind, sigma, axis)) in enumerate(featureBank):
+        if kind == 'sobel':
+            features[i] = filters.sobel(features[gaussians[sigma]], axis,
+                                        output=float32)
+    return features
+
+
+def randomImage(rng, w, h):
+    # A gray image with a gradient, dark ellipses like specimens on a
+    # drawer, and noise, so every filter has edges to respond to
+    (yy, xx) = mgrid[0:h, 0:w]
+    image = 180 + 40*xx/float(w) - 30*yy/float(h)
+    for i in range(rng.randint(1, 8)):
+        (cx, cy) = (rng.randint(w), rng.randint(h))
+        (rx, ry) = (rng.randint(3, 40), rng.randint(3, 40))
+        image[((xx-cx)/float(rx))**2 + ((yy-cy)/float(ry))**2 < 1] = \
+            rng.randint(0, 120)
+    image += rng.normal(0, rng.choice([0, 2, 20]), (h, w))
+    return Image.fromarray(clip(image, 0, 255).astype(uint8))
+
+
+def seamDistance(c, n, tileSize):
+    # Pixels from coordinate c to the nearest seam between tiles, along an
+    # axis of n pixels. The pixels on either side of a seam are 0 from it
+    seams = range(tileSize, n, tileSize)
+    return min([s-1-c if c < s else c-s for s in seams] + [n])
+
+
+def checkTiles(rng, trials):
+    # Compute the features of random images tile by tile, and compare them
+    # with filtering the whole image. The halo around each tile must make
+    # the pixels next to the seams between tiles the same as everywhere else
+    for trial in range(trials):
+        data = SegmentationData()
+        data.tileSize = TILE_SIZES[rng.randint(len(TILE_SIZES))]
+        (w, h) = (rng.randint(20, 300), rng.randint(20, 300))
+        gray = randomImage(rng, w, h)
+
+        folder = tempfile.mkdtemp()
+        try:
+            features = data.computeFeatures(
+                gray, [os.path.join(folder, "features.npy")])
+            tiled = array(features)
+            del features
+        finally:
+            shutil.rmtree(folder)
+
+        expected = referenceFeatures(array(gray, dtype='f')/255,
+                                     data.featureBank)
+        bad = argwhere(tiled != expected)
+        if len(bad) > 0:
+            (c, y, x) = bad[0]
+            seam = min([seamDistance(x, w, data.tileSize),
+                        seamDistance(y, h, data.tileSize)])
+            raise AssertionError(
+                "%dx%d image in %d pixel tiles: %d values differ, the first "
+                "is feature %s at (%d,%d), %d pixels from a seam: %r != %r"
+                % (w, h, data.tileSize, len(bad), data.featureBank[c], x, y,
+                   seam, tiled[c, y, x], expected[c, y, x]))
+
+
+def main():
+    """Check the features computed tile by tile against filtering the whole
+    image at once:
+
+        $ python2.7 equivalence.py [-r trials] [-s seed]
+
+    An AssertionError names the first image where the two differ"""
+
+    trials = TRIALS
+    seed = 0
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-r':
+            trials = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-s':
+            seed = int(sys.argv[i+1])
+            i += 2
+        else:
+            sys.exit(main.__doc__)
+
+    checkTiles(random.RandomState(seed), trials)
+    sys.stderr.write("all checks passed\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,9 @@ import numpy as np
 import os.path
 
 from Pt import *
+from CameraFeed import CaptureThread, openTestingCamera
+from TrayImage import TrayImageCache, TrayRenderer
+from Profiler import PROFILER
 import Util
 import Constants as C
 
@@ -147,7 +150,8 @@ class AppData(QtCore.QObject):
         # Load the image
         self.trayPath = image_fname
         self.logger.log("LOAD image scan file %s" % self.trayPath, 1)
-        self.trayImage = cv2.imread(self.trayPath, cv2.IMREAD_COLOR)
+        self.trayImage = TrayRenderer(TrayImageCache(
+            cv2.imread(self.trayPath, cv2.IMREAD_COLOR)))
         self.csvPath = csv_fname
 
         # Load csv file
@@ -183,20 +187,16 @@ class AppData(QtCore.QObject):
         self.bugBoxList.clearUndoRedoStacks()
 
     def startCameraFeed(self):
-        """Begin the camera feed and set up the timer loop."""
+        """Begin the camera capture thread and set up the timer loop."""
 
         if not self.camOn:
-            self.frameTimer = QtCore.QTimer()
-            self.frameTimer.timeout.connect(self.grabNewCameraFrame)
-
+            maxSize = (AppData.CAM_MAX_WIDTH, AppData.CAM_MAX_HEIGHT)
             if self.testdata is not None:
-                self.capture = cv2.VideoCapture(self.testdata.camfile)
-                sourcefps = self.capture.get(cv2.cv.CV_CAP_PROP_FPS)
-                sourcefps = sourcefps if sourcefps != 0 else 30
-                self.frameTimer.start(1000/float(sourcefps))
+                self.camera = CaptureThread(openTestingCamera(self.testdata),
+                                            maxSize, paced=True)
             else:
-                self.capture = cv2.VideoCapture(0)
-                self.frameTimer.start(1000/60)
+                self.camera = CaptureThread(0, maxSize)
+            self.camera.start()
 
             self.loopTimer = QtCore.QTimer()
             self.loopTimer.timeout.connect(self.getNewCameraFrame)
@@ -207,91 +207,45 @@ class AppData(QtCore.QObject):
             self.logger.log("INIT camera", 0)
 
     def getNewCameraFrame(self):
-        """This function is called by the timer 30 times a second to fetch a new
-        frame from the camera, have it processed, and display the final result
-        to on screen."""
+        """This function is called by the timer 30 times a second to fetch the
+        newest frame from the capture thread, have it processed, and display
+        the final result to on screen."""
 
-        # Get new camera frame and downsample it
+        # Get newest camera frame, already downsampled by the capture thread
         start_time = time()
-        (_, self.cameraImage) = self.capture.retrieve()
-        ts = self.capture.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-        if self.cameraImage is not None:
-            while (self.cameraImage.shape[0] > AppData.CAM_MAX_HEIGHT or
-                   self.cameraImage.shape[1] > AppData.CAM_MAX_WIDTH):
-                self.cameraImage = cv2.pyrDown(self.cameraImage)
-
+        (frame, ts) = self.camera.getLatestFrame()
+        if frame is not None:
+            self.cameraImage = frame
 
             # Process and modify the camera and static frames
-            (big_image, small_image, self.bugBoxList) = self.cvImpl.amendFrame(
-                self.cameraImage, self.trayImage, self.lblBig.imageScaleRatio,
-                self.lblSmall.imageScaleRatio, self.bugBoxList)
-
-            if self.cvImpl.allowEditing():
-                dB = int(AppData.DRAW_DELTA/self.lblBig.imageScaleRatio)
-                self.draw_editing_ui(big_image, C.GREEN, C.RED, C.BLUE, dB)
-
-            # Display the modified frame to the user
-            self.lblBig.setImage(big_image)
-            self.lblSmall.setImage(small_image)
-        else:
+            with PROFILER.span('frame'):
+                self.trayImage.setSelectedBox(self.selectedEditBox)
+                (big, small, self.bugBoxList) = self.cvImpl.amendFrame(
+                    self.cameraImage, self.trayImage,
+                    self.lblBig.getCurrentSize(),
+                    self.lblSmall.getCurrentSize(), self.bugBoxList)
+                (big_image, big_scale) = big
+                (small_image, small_scale) = small
+
+                # Display the modified frame to the user
+                with PROFILER.span('display'):
+                    self.lblBig.setImage(big_image, big_scale)
+                    self.lblSmall.setImage(small_image, small_scale)
+        elif not self.camera.is_alive():
             print('No Frame')
 
+        # Frames that take longer than the frame budget hold back the next one
         end_time = time()
-        self.loopTimer.start(max(0, 1000.0/AppData.FPS_TARGET-(end_time-start_time)))
-
-    def grabNewCameraFrame(self):
-        self.capture.grab()
+        if end_time - start_time > 1.0/AppData.FPS_TARGET:
+            PROFILER.drop('frame')
+        self.loopTimer.start(
+            max(0, 1000.0/AppData.FPS_TARGET-(end_time-start_time)))
 
     def setMousepos(self, x, y):
         """Update the current mouse position"""
 
         self.mousePos = (x, y)
 
-    def draw_editing_ui(self, image, regular, selected, active, a):
-        """Given an input image, draw all of the generated boxes on the image.
-        Optional colour paramaters can also be supplied.
-
-        Keyword Arguments:
-        image -- the numpy array image that the boxes will be drawn on
-        regular -- the colour of the boxes
-        selected -- the colour of the selected box
-        """
-
-        for i in range(len(self.bugBoxList)):
-            b = self.bugBoxList[i].static
-            (px, py) = self.bugBoxList[i].point
-            t = max(int(a/5), 1)
-            col = None
-
-            if i == self.selectedEditBox:
-                # Draw box
-                cv2.rectangle(image, b[0:2], b[2:4], selected, t)
-
-                # Draw delete button
-                cv2.rectangle(image, (b[2]-a, b[1]+3*a), (b[2]-3*a, b[1]+a),
-                              selected, t)
-                cv2.line(image, (b[2]-a, b[1]+3*a), (b[2]-3*a, b[1]+a),
-                         selected, t)
-                cv2.line(image, (b[2]-3*a, b[1]+3*a), (b[2]-a, b[1]+a),
-                         selected, t)
-
-                # Draw Box ID
-                ((_, h), _) = cv2.getTextSize(
-                    self.bugBoxList[i].name, cv2.FONT_HERSHEY_SIMPLEX, a/18.0,
-                    t)
-                cv2.putText(image, self.bugBoxList[i].name,
-                            (b[0]-int(a/2), b[3]+h), cv2.FONT_HERSHEY_SIMPLEX,
-                            a/18.0, C.WHITE, t)
-                col = selected
-            else:
-                col = regular
-
-            # Draw point marker
-            if i != self.removedBug:
-                cv2.line(image, (px, py-a), (px, py+a), col, t)
-                cv2.line(image, (px+a, py), (px-a, py), col, t)
-                cv2.circle(image, (px, py), a, col, t)
-
     def exportToCSV(self, ask_save=True):
         """Exports the bugBoxList data to a CSV file"""
 
@@ -315,12 +269,7 @@ class AppData(QtCore.QObject):
             ret = message.exec_()
 
         if ret == QtGui.QMessageBox.Save:
-            f = open(self.csvPath, "w")
-            f.write("Insect Id, Rectangle x1, y1, x2, y1, Point x, y\n")
-            for b in self.bugBoxList:
-                f.write(b.name + ", " +
-                        str(b.getStaticBox())[1:-1] + ", " +
-                        str(b.getPoint())[1:-1] + "\n")
+            self.bugBoxList.writeCSV(self.csvPath)
             self.window.statusBar().showMessage(
                 "Saved data to %s" % str(os.path.split(self.csvPath)[1]))
             return True
@@ -434,7 +383,7 @@ class AppData(QtCore.QObject):
             # If a box is not selected, check for clicking on a box to
             # to select it
             clickedOn = False
-            for i in range(len(self.bugBoxList)):
+            for i in self.bugBoxList.query((mx-pad, my-pad, mx+pad, my+pad)):
                 (x1, y1, x2, y2) = self.bugBoxList[i].static
                 if Util.pointInBox((mx, my), (x1-pad, y1-pad, x2+pad, y2+pad)):
                     self.sigSelectedBox.emit(i)
@@ -466,8 +415,8 @@ class AppData(QtCore.QObject):
 
         # Show box select cursor if hovered over box
         self.lblBig.setCursor(self.normalCursor)
-        for b in self.bugBoxList:
-            if Util.pointInBox(p, b.static):
+        for i in self.bugBoxList.query((p[0], p[1], p[0], p[1])):
+            if Util.pointInBox(p, self.bugBoxList[i].static):
                 self.lblBig.setCursor(self.selectCursor)
 
         if self.selectedEditBox is not None:
@@ -590,6 +539,15 @@ class AppData(QtCore.QObject):
 
         exit = self.exportToCSV()
         if exit:
+            self.cvImpl.shutdown()
+            if PROFILER.enabled:
+                PROFILER.dump(self.logger)
+            if self.camOn:
+                self.camera.stop()
+                self.logger.log(
+                    'CAMERA captured %d, processed %d, dropped %d frames' %
+                    (self.camera.captured, self.camera.delivered,
+                     self.camera.dropped), 0)
             self.logger.stop()
             QtCore.QCoreApplication.instance().quit()
 
@@ -0,0 +1,243 @@
+# Camera capture module
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from time import time, sleep
+import threading
+import numpy as np
+import cv2
+
+from Profiler import PROFILER
+from SyntheticCamera import SyntheticCamera
+
+
+def openCapture(source):
+    """Open a camera source.
+
+    Keyword Arguments:
+    source -- camera index or video file path passed to cv2.VideoCapture, or
+        an object with the same interface, like a SyntheticCamera
+
+    Return: the capture object"""
+
+    if hasattr(source, 'grab'):
+        return source
+    return cv2.VideoCapture(source)
+
+
+def openTestingCamera(testdata):
+    """Open the camera source of a testing file, which is its synthetic
+    camera if it has one, and its video otherwise.
+
+    Keyword Arguments:
+    testdata -- Util.TestingData instance
+
+    Return: the capture object"""
+
+    if testdata.synthetic is not None:
+        return SyntheticCamera.fromConfig(
+            testdata.synthetic, testdata.trayfile, testdata.csvfile)
+    return cv2.VideoCapture(testdata.camfile)
+
+
+class DownscalePlan:
+    """Fixed plan for shrinking camera frames until they fit a maximum size.
+
+    The number of pyrDown levels only depends on the frame size, so it is
+    worked out once along with the buffers each level is written to."""
+
+    def __init__(self, shape, max_size):
+        """Constructor
+
+        Keyword Arguments:
+        shape -- the (height, width, channels) shape of the camera frames
+        max_size -- (width, height) the frames need to fit in"""
+
+        self.shape = tuple(shape)
+        (maxw, maxh) = max_size
+        (h, w) = shape[0:2]
+        self.buffers = []
+        while h > maxh or w > maxw:
+            (h, w) = ((h+1)//2, (w+1)//2)
+            self.buffers.append(np.empty((h, w) + self.shape[2:], np.uint8))
+
+    def apply(self, frame, dst=None):
+        """Shrink a frame.
+
+        Keyword Arguments:
+        frame -- camera frame with the shape the plan was made for
+        dst -- array for the shrunk frame, or None to use the buffer of the
+            plan
+
+        Return: the shrunk frame"""
+
+        if len(self.buffers) == 0:
+            if dst is None:
+                return frame
+            dst[...] = frame
+            return dst
+
+        for b in self.buffers[:-1]:
+            frame = cv2.pyrDown(frame, b)
+        if dst is None:
+            dst = self.buffers[-1]
+        return cv2.pyrDown(frame, dst)
+
+    def outputShape(self):
+        """Return: the shape of the shrunk frames"""
+
+        if len(self.buffers) == 0:
+            return self.shape
+        return self.buffers[-1].shape
+
+
+class CaptureThread(threading.Thread):
+    """Thread that owns the camera and keeps decoding frames into a small ring
+    of frame buffers, independent of how long the GUI takes to process them.
+
+    The GUI thread only ever takes the newest frame. Frames that are replaced
+    before the GUI gets to them are counted as dropped. Frames are shrunk to
+    fit the maximum size on this thread, before they are published."""
+
+    RING_SIZE = 3
+
+    # Seconds stop() waits for the capture loop to end
+    STOP_TIMEOUT = 1.0
+
+    def __init__(self, source, max_size, paced=False):
+        """Constructor
+
+        Keyword Arguments:
+        source -- camera source, as passed to openCapture(..)
+        max_size -- (width, height) that published frames need to fit in
+        paced -- whether to deliver frames at the frame rate of the source.
+            Cameras are paced by the device, but video files should be paced
+            so they play back in real time"""
+
+        super(CaptureThread, self).__init__()
+        self.daemon = True
+
+        self.capture = openCapture(source)
+        self.fps = self.capture.get(cv2.cv.CV_CAP_PROP_FPS)
+        self.fps = self.fps if self.fps > 0 else 30
+        self.paced = paced
+
+        # The downscale plan is made from the resolution the capture reports,
+        # and only remade if a frame ever comes in with another size
+        self.maxSize = max_size
+        self.plan = None
+        w = int(self.capture.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
+        h = int(self.capture.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
+        if w > 0 and h > 0:
+            self.plan = DownscalePlan((h, w, 3), max_size)
+        self.decoded = None
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.ring = [None]*CaptureThread.RING_SIZE
+        self.latest = -1
+        self.reading = -1
+        self.latestTime = None
+        self.fresh = False
+
+        # Counters
+        self.captured = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def run(self):
+        """Capture loop"""
+
+        self.running = True
+        slot = 0
+        nextTime = time()
+        while self.running:
+            if self.paced:
+                delay = nextTime - time()
+                if delay > 0:
+                    sleep(delay)
+                nextTime = max(nextTime + 1.0/self.fps, time())
+
+            if not self.capture.grab():
+                self.failed += 1
+                if self.paced:
+                    # End of the video file
+                    break
+                sleep(0.01)
+                continue
+            ts = time()
+
+            with PROFILER.span('capture'):
+                (ok, self.decoded) = self.capture.retrieve(self.decoded)
+            if not ok or self.decoded is None:
+                self.failed += 1
+                continue
+            if self.plan is None or self.plan.shape != self.decoded.shape:
+                self.plan = DownscalePlan(self.decoded.shape, self.maxSize)
+
+            # Shrink into a slot that is neither the newest frame nor the one
+            # the GUI thread is currently using
+            with self.lock:
+                while slot == self.latest or slot == self.reading:
+                    slot = (slot + 1) % CaptureThread.RING_SIZE
+            if self.ring[slot] is None or \
+                    self.ring[slot].shape != self.plan.outputShape():
+                self.ring[slot] = np.empty(self.plan.outputShape(), np.uint8)
+            with PROFILER.span('downscale'):
+                image = self.plan.apply(self.decoded, self.ring[slot])
+
+            with self.lock:
+                self.ring[slot] = image
+                if self.fresh:
+                    self.dropped += 1
+                    PROFILER.drop('capture')
+                self.latest = slot
+                self.latestTime = ts
+                self.fresh = True
+                self.captured += 1
+
+        self.running = False
+        self.capture.release()
+
+    def getLatestFrame(self):
+        """Take the newest captured frame. The frame stays valid until the next
+        call to getLatestFrame().
+
+        Return: (frame, timestamp)
+        frame -- the newest frame, or None if no new frame has been captured
+            since the last call
+        timestamp -- time.time() at which the frame was grabbed"""
+
+        with self.lock:
+            if not self.fresh:
+                return (None, None)
+
+            self.fresh = False
+            self.reading = self.latest
+            self.delivered += 1
+            return (self.ring[self.latest], self.latestTime)
+
+    def stop(self):
+        """Stop the capture loop and release the camera. Waits for the loop to
+        end, so that the camera is released before the application quits,
+        unless the camera is stuck for longer than STOP_TIMEOUT"""
+
+        self.running = False
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(CaptureThread.STOP_TIMEOUT)
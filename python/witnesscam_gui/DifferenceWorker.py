@@ -0,0 +1,240 @@
+# Frame difference worker process
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from time import time
+import multiprocessing
+import numpy as np
+
+from Pt import Pt
+from Util import findWeightedMedianPoint2D
+from FrameDifference import FrameDifferenceEngine
+from Profiler import PROFILER
+
+
+def sharedImage(buf, shape):
+    """View a shared memory buffer as a uint8 image.
+
+    Keyword Arguments:
+    buf -- multiprocessing.RawArray of bytes
+    shape -- shape of the image, must fit in the buffer
+
+    Return: numpy array sharing memory with the buffer"""
+
+    size = int(np.prod(shape))
+    return np.frombuffer(buf, np.uint8, size).reshape(shape)
+
+
+def differenceWorkerLoop(conn, frames, outputs, background, mask):
+    """Main loop of the worker process. Receives jobs from the pipe, and sends
+    back the frame statistics, while the difference image is written to the
+    shared output buffer of the job.
+
+    Keyword Arguments:
+    conn -- worker end of a multiprocessing.Pipe
+    frames -- list of the shared camera frame buffers
+    outputs -- list of the shared difference image buffers
+    background -- shared Lab camera background buffer
+    mask -- shared tray mask buffer"""
+
+    # The process is forked from the GUI, and may have copied the profiler
+    # lock while another thread held it
+    PROFILER.forked()
+
+    engine = FrameDifferenceEngine()
+    config = None
+    while True:
+        msg = conn.recv()
+        if msg[0] == 'stop':
+            break
+        elif msg[0] == 'config':
+            # (shape, threshold, tray bounding box)
+            config = msg[1:]
+            continue
+
+        (_, slot) = msg
+        ((h, w), threshold, (p0, p1)) = config
+        roi = [Pt(p0[0], p0[1]), Pt(p1[0], p1[1])]
+        frame = sharedImage(frames[slot], (h, w, 3))
+        (tframe, output, offset) = engine.compute(
+            frame, sharedImage(background, (h, w, 3)),
+            sharedImage(mask, (h, w)), threshold, roi)
+        sharedImage(outputs[slot], (h, w))[...] = output
+
+        medpos = findWeightedMedianPoint2D(
+            tframe, [roi[0]-offset, roi[1]-offset])
+        if medpos is not None:
+            medpos = (medpos + offset).t()
+        conn.send((slot, float(np.sum(tframe)), medpos))
+
+    conn.close()
+
+
+class DifferenceWorkerError(Exception):
+    """Raised when the worker process has exited or stopped answering"""
+
+
+class DifferenceWorker:
+    """Runs the frame difference and centroid computation in a second process,
+    so it uses another core while the GUI thread draws the results.
+
+    Camera frames, the background and the mask are handed over through shared
+    memory, and only the frame statistics go through the pipe. Jobs are
+    pipelined, so the result of a frame is returned by the call that submits
+    the next one.
+
+    The worker is forked, so it should be started before any other thread,
+    such as the camera capture thread."""
+
+    SLOTS = 2
+
+    # Seconds to wait for the result of a frame before giving up on the worker
+    RESULT_TIMEOUT = 5.0
+
+    def __init__(self, max_shape):
+        """Constructor
+
+        Keyword Arguments:
+        max_shape -- (height, width) of the largest frame that will be
+            processed"""
+
+        (h, w) = max_shape[0:2]
+        self.maxShape = (h, w)
+        self.frames = [multiprocessing.RawArray('B', h*w*3)
+                       for i in range(DifferenceWorker.SLOTS)]
+        self.outputs = [multiprocessing.RawArray('B', h*w)
+                        for i in range(DifferenceWorker.SLOTS)]
+        self.background = multiprocessing.RawArray('B', h*w*3)
+        self.mask = multiprocessing.RawArray('B', h*w)
+
+        (self.conn, child) = multiprocessing.Pipe()
+        self.worker = multiprocessing.Process(
+            target=differenceWorkerLoop,
+            args=(child, self.frames, self.outputs, self.background,
+                  self.mask))
+        self.worker.daemon = True
+        self.worker.start()
+
+        self.key = None
+        self.shape = None
+        self.slot = 0
+        self.inFlight = 0
+
+    def fits(self, shape):
+        """Whether frames of the given shape can be handed to the worker"""
+
+        return shape[0] <= self.maxShape[0] and shape[1] <= self.maxShape[1]
+
+    def configure(self, key, background, mask, threshold, roi):
+        """Give the worker a new background and mask. Waits for the jobs in
+        flight, and discards their results since they used the old ones.
+
+        Keyword Arguments:
+        key -- hashable value that changes whenever any of the other arguments
+            change
+        background -- the Lab camera background
+        mask -- single channel uint8 tray mask
+        threshold -- differences less than this value are set to 0
+        roi -- list of two points Pt(x,y), the tray bounding box"""
+
+        self.drain()
+        (h, w) = mask.shape
+        sharedImage(self.background, (h, w, 3))[...] = background
+        sharedImage(self.mask, (h, w))[...] = mask
+        self.send(('config', (h, w), threshold, (roi[0].t(), roi[1].t())))
+        self.key = key
+        self.shape = (h, w)
+
+    def process(self, frame):
+        """Submit a camera frame, and get the result of the previous one.
+
+        Keyword Arguments:
+        frame -- the BGR camera frame, the same size as the background
+
+        Return: None if there is no previous frame, otherwise
+            (output, total, medpos)
+        output -- uint8 difference image of the previous frame. It is only
+            valid until the next call to process(..)
+        total -- sum of the difference image
+        medpos -- Pt(x,y) weighted median of the difference image, or None"""
+
+        sharedImage(self.frames[self.slot], self.shape + (3,))[...] = frame
+        self.send(('frame', self.slot))
+        self.slot = (self.slot + 1) % DifferenceWorker.SLOTS
+        self.inFlight += 1
+
+        if self.inFlight < DifferenceWorker.SLOTS:
+            return None
+
+        with PROFILER.span('worker'):
+            (slot, total, medpos) = self.receive()
+        self.inFlight -= 1
+        if medpos is not None:
+            medpos = Pt(medpos[0], medpos[1])
+        return (sharedImage(self.outputs[slot], self.shape), total, medpos)
+
+    def drain(self):
+        """Wait for all the jobs in flight and throw away their results"""
+
+        while self.inFlight > 0:
+            self.receive()
+            self.inFlight -= 1
+
+    def send(self, msg):
+        """Send a message to the worker.
+
+        Raises DifferenceWorkerError if the worker has exited"""
+
+        try:
+            self.conn.send(msg)
+        except (IOError, OSError):
+            raise DifferenceWorkerError('difference worker exited')
+
+    def receive(self):
+        """Wait for the next result from the worker.
+
+        Return: the result sent by differenceWorkerLoop(..)
+
+        Raises DifferenceWorkerError if the worker exits, or does not answer
+        within RESULT_TIMEOUT seconds"""
+
+        deadline = time() + DifferenceWorker.RESULT_TIMEOUT
+        while not self.conn.poll(0.1):
+            if not self.worker.is_alive():
+                raise DifferenceWorkerError('difference worker exited')
+            if time() > deadline:
+                raise DifferenceWorkerError(
+                    'no answer from the difference worker in %.1f seconds'
+                    % DifferenceWorker.RESULT_TIMEOUT)
+        try:
+            return self.conn.recv()
+        except (EOFError, IOError, OSError):
+            raise DifferenceWorkerError('difference worker exited')
+
+    def stop(self):
+        """Stop the worker process, killing it if it does not answer"""
+
+        try:
+            self.drain()
+            self.send(('stop',))
+            self.worker.join(DifferenceWorker.RESULT_TIMEOUT)
+        except DifferenceWorkerError:
+            pass
+        if self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
@@ -0,0 +1,217 @@
+# Frame differencing module
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import math
+import numpy as np
+import cv2
+
+from Pt import Pt
+from Util import quadrilateralArea
+from Profiler import PROFILER
+
+
+class FrameDifferenceEngine:
+    """Computes the grayscale difference between a camera frame and the saved
+    Lab background of the camera.
+
+    All of the intermediate images are kept in work buffers that are only
+    reallocated when the resolution of the camera frame or the region of
+    interest changes, so the cost of a frame does not include any full frame
+    allocations."""
+
+    BLUR_SIZE = (5, 5)
+
+    def __init__(self):
+        """Constructor"""
+
+        self.shape = None
+        self.roi = None
+
+    def allocate(self, shape, roi):
+        """Allocate the work buffers for frames of the given shape.
+
+        Keyword Arguments:
+        shape -- the (height, width, ...) shape of the camera frame
+        roi -- (x1,y1,x2,y2) region of the frame the work is done on"""
+
+        (h, w) = shape[0:2]
+        if self.shape != (h, w):
+            self.output = np.empty((h, w), np.uint8)
+        self.shape = (h, w)
+        self.roi = roi
+        self.output[...] = 0
+
+        (x1, y1, x2, y2) = roi
+        (h, w) = (y2-y1, x2-x1)
+        self.labFrame = np.empty((h, w, 3), np.uint8)
+        self.absDiff = np.empty((h, w, 3), np.uint8)
+        self.channelDiff = np.empty((h, w, 3), np.float32)
+        self.magnitude = np.empty((h, w), np.float32)
+        self.difference = np.empty((h, w), np.float32)
+
+    def cropRegion(self, shape, roi):
+        """Pad the region of interest by the blur kernel radius, so that the
+        blur gives the same result as on the full frame, and clip it to the
+        frame.
+
+        Keyword Arguments:
+        shape -- the (height, width, ...) shape of the camera frame
+        roi -- list of two points Pt(x,y), the top left and bottom right of
+            the region of interest, or None for the whole frame
+
+        Return: (x1,y1,x2,y2) region of the frame, with (x2,y2) exclusive"""
+
+        (h, w) = shape[0:2]
+        if roi is None:
+            return (0, 0, w, h)
+
+        pad = FrameDifferenceEngine.BLUR_SIZE[0]//2
+        return (max(roi[0].x-pad, 0), max(roi[0].y-pad, 0),
+                min(roi[1].x+pad+1, w), min(roi[1].y+pad+1, h))
+
+    def compute(self, frame, background, mask, threshold, roi=None):
+        """Compute the thresholded difference image of a camera frame.
+
+        Keyword Arguments:
+        frame -- the BGR camera frame
+        background -- the Lab camera background, the same size as frame
+        mask -- single channel uint8 image, 1 where the difference should be
+            kept and 0 where it should be blocked off
+        threshold -- differences less than this value are set to 0
+        roi -- list of two points Pt(x,y), the top left and bottom right of
+            the region that can have a difference. Everything outside it must
+            be blocked off by the mask
+
+        Return: (difference, output, offset)
+        difference -- float32 difference image of the region of interest, used
+            for the frame statistics
+        output -- uint8 version of the difference image, the size of the frame
+        offset -- Pt(x,y) position of the top left of 'difference' in the frame
+
+        Both images are work buffers of the engine, and are overwritten by the
+        next call to compute(..)"""
+
+        region = self.cropRegion(frame.shape, roi)
+        if self.shape != frame.shape[0:2] or self.roi != region:
+            self.allocate(frame.shape, region)
+
+        (x1, y1, x2, y2) = region
+        frame = frame[y1:y2, x1:x2]
+        background = background[y1:y2, x1:x2]
+        mask = mask[y1:y2, x1:x2]
+
+        # Per pixel euclidean distance between the frame and the background
+        # in Lab space
+        with PROFILER.span('lab'):
+            cv2.cvtColor(frame, cv2.cv.CV_BGR2Lab, self.labFrame)
+        with PROFILER.span('difference'):
+            cv2.absdiff(background, self.labFrame, self.absDiff)
+            self.channelDiff[...] = self.absDiff
+            np.multiply(self.channelDiff, self.channelDiff,
+                        out=self.channelDiff)
+            np.sum(self.channelDiff, axis=2, out=self.magnitude)
+            np.sqrt(self.magnitude, out=self.magnitude)
+
+            # Block off the masked areas and normalize to the range of one
+            # channel
+            np.multiply(self.magnitude, mask, out=self.magnitude)
+            self.magnitude *= 1/math.sqrt(3)
+
+        with PROFILER.span('blur'):
+            cv2.GaussianBlur(self.magnitude, FrameDifferenceEngine.BLUR_SIZE,
+                             0, self.difference)
+            cv2.threshold(self.difference, threshold, 0, cv2.THRESH_TOZERO,
+                          self.difference)
+        self.output[y1:y2, x1:x2] = self.difference
+
+        return (self.difference, self.output, Pt(x1, y1))
+
+
+class TrayMaskCache:
+    """Keeps the mask that blocks off everything outside the tray area, and the
+    box of the currently removed insect, along with the area left unmasked.
+
+    The mask is only rasterized again when the cache is invalidated, or when
+    the frame shape, tray corners, or selection box it was built from
+    change."""
+
+    def __init__(self):
+        """Constructor"""
+
+        self.version = 0
+        self.key = None
+        self.mask = None
+        self.area = -1
+
+    def invalidate(self):
+        """Notifies the cache that the tray area or selection box changed"""
+
+        self.version += 1
+
+    def get(self, shape, poly_points, selection_box=None):
+        """Returns the mask for the current tray area and selection box.
+
+        Keyword Arguments:
+        shape -- the (height, width, ...) shape of the camera frame
+        poly_points -- list of the four tray corners Pt(x,y)
+        selection_box -- (x1,y1,x2,y2) live box of the removed insect, or None
+
+        Return: (mask, area)
+        mask -- single channel uint8 image, 1 inside the tray area and 0
+            outside of it and inside the selection box
+        area -- the area of the tray not blocked off by the selection box"""
+
+        (h, w) = shape[0:2]
+        key = (self.version, (h, w), tuple(p.t() for p in poly_points),
+               None if selection_box is None else tuple(selection_box))
+        if key != self.key:
+            self.build((h, w), poly_points, selection_box)
+            self.key = key
+
+        return (self.mask, self.area)
+
+    def build(self, shape, poly_points, selection_box):
+        """Rasterize the mask and compute its area.
+
+        Keyword Arguments:
+        shape -- the (height, width) of the mask
+        poly_points -- list of the four tray corners Pt(x,y)
+        selection_box -- (x1,y1,x2,y2) live box of the removed insect, or
+            None"""
+
+        if self.mask is None or self.mask.shape != shape:
+            self.mask = np.zeros(shape, np.uint8)
+        else:
+            self.mask[...] = 0
+
+        # Block off the area outside the tray
+        poly = np.array([p.t() for p in poly_points], dtype=np.int32)
+        self.area = quadrilateralArea([p.t() for p in poly_points])
+        cv2.drawContours(self.mask, [poly], 0, 1, -1)
+
+        # Block off the box containing the removed insect
+        if selection_box is not None:
+            b = selection_box
+            q0 = (int(b[0]), int(b[1]))
+            q1 = (int(b[2]), int(b[1]))
+            q2 = (int(b[2]), int(b[3]))
+            q3 = (int(b[0]), int(b[3]))
+            poly = np.array([q0, q1, q2, q3], dtype=np.int32)
+            self.area = self.area - quadrilateralArea([q0, q1, q2, q3])
+            cv2.drawContours(self.mask, [poly], 0, 0, -1)
@@ -202,7 +202,93 @@ class FileBrowser(QtGui.QFrame):
         self.sigFileSelected.emit(os.path.join(self.currentPath, i.text(0)))
 
 
-class BigLabel(QtGui.QLabel):
+class ImageLabel(QtGui.QLabel):
+    """Label that displays images in numpy arrays.
+
+    The image is scaled and converted into a BGRA buffer that is kept at the
+    size of the label, and painted from a QImage that wraps that buffer. Both
+    are only reallocated when the displayed size changes."""
+
+    def __init__(self, parent=None):
+        """Object constructor"""
+
+        super(ImageLabel, self).__init__(parent)
+        self.imageScaleRatio = 1
+        self.displayBuffer = None
+        self.displayImage = None
+        self.scaledBuffers = dict()
+
+    def setImage(self, cv_image, source_scale=1.0):
+        """Displays an image in the label.
+
+        Keyword Arguments:
+        cv_image -- OpenCV2 image, represented as a numpy array
+        source_scale -- factor that scaled the original image down to
+            cv_image, so that imageScaleRatio stays relative to the original
+            image"""
+
+        # Scale image to fit in label
+        originalSize = (cv_image.shape[1], cv_image.shape[0])
+        (w, h, rat) = computeImageScaleFactor(
+            originalSize, self.getCurrentSize())
+        self.imageScaleRatio = rat*source_scale
+
+        if self.displayBuffer is None or \
+                self.displayBuffer.shape[0:2] != (h, w):
+            self.displayBuffer = np.empty((h, w, 4), np.uint8)
+            self.displayImage = QtGui.QImage(
+                self.displayBuffer, w, h, self.displayBuffer.strides[0],
+                QtGui.QImage.Format_ARGB32)
+            self.scaledBuffers = dict()
+            self.updateGeometry()
+
+        # Handle grayscale and color images. Scale first, so the colour
+        # conversion is done on the smaller image
+        if cv_image.ndim == 3 and cv_image.shape[2] == 4:
+            cv2.resize(cv_image, (w, h), self.displayBuffer)
+        else:
+            shape = cv_image.shape[2:]
+            if originalSize == (w, h):
+                scaled = cv_image
+            else:
+                if shape not in self.scaledBuffers:
+                    self.scaledBuffers[shape] = np.empty((h, w) + shape,
+                                                         np.uint8)
+                scaled = cv2.resize(cv_image, (w, h),
+                                    self.scaledBuffers[shape])
+            if cv_image.ndim == 2:
+                cv2.cvtColor(scaled, cv2.cv.CV_GRAY2BGRA, self.displayBuffer)
+            else:
+                cv2.cvtColor(scaled, cv2.cv.CV_BGR2BGRA, self.displayBuffer)
+
+        self.update()
+
+    def paintEvent(self, ev):
+        """Paints the displayed image.
+
+        Keyword Arguments:
+        ev -- PySide.QtGui.QPaintEvent"""
+
+        if self.displayImage is not None:
+            painter = QtGui.QPainter(self)
+            painter.drawImage(0, 0, self.displayImage)
+            painter.end()
+
+    def sizeHint(self):
+        """The label is the size of the displayed image"""
+
+        if self.displayBuffer is None:
+            return super(ImageLabel, self).sizeHint()
+        (h, w) = self.displayBuffer.shape[0:2]
+        return QtCore.QSize(w, h)
+
+    def minimumSizeHint(self):
+        """The label is the size of the displayed image"""
+
+        return self.sizeHint()
+
+
+class BigLabel(ImageLabel):
     """The large sized label with convienence function for displaying images
     in numpy arrays, as well as signals for mouse events"""
 
@@ -224,7 +310,6 @@ class BigLabel(QtGui.QLabel):
         self.data = data
         self.initUI()
         self.setMouseTracking(True)
-        self.imageScaleRatio = 1
         # self.setPixmap(QtGui.QPixmap(self.originalSize[0],
         #                              self.originalSize[1]))
         self.generateInitialImage()
@@ -233,30 +318,6 @@ class BigLabel(QtGui.QLabel):
     def initUI(self):
         self.setAlignment(QtCore.Qt.AlignTop)
 
-    def setImage(self, cv_image):
-        """Displays an image in the label.
-
-        Keyword Arguments:
-        cv_image -- OpenCV2 image, represented as a numpy array"""
-
-        # Handle grayscale and color images
-        if cv_image.ndim == 2:
-            cv_image = cv2.cvtColor(cv_image, cv2.cv.CV_GRAY2BGRA)
-        else:
-            cv_image = cv2.cvtColor(cv_image, cv2.cv.CV_BGR2BGRA)
-
-        # Scale image to fit in label
-        originalSize = (cv_image.shape[1], cv_image.shape[0])
-        (w, h, rat) = computeImageScaleFactor(
-            originalSize, self.getCurrentSize())
-        self.imageScaleRatio = rat
-
-        # Convert opencv image to pyside Pixmap for display in label
-        cv_image = cv2.resize(cv_image, (w, h))
-        img = QtGui.QImage(cv_image, cv_image.shape[1], cv_image.shape[0],
-                           cv_image.strides[0], QtGui.QImage.Format_ARGB32)
-        self.setPixmap(QtGui.QPixmap.fromImage(img))
-
     def mousePressEvent(self, ev):
         """Invoked when the user presses the mouse on the label.
 
@@ -339,7 +400,7 @@ class BigLabel(QtGui.QLabel):
         self.setImage(img)
 
 
-class SmallLabel(QtGui.QLabel):
+class SmallLabel(ImageLabel):
     """The small sized label with convienence function for displaying images
     in numpy arrays"""
 
@@ -355,7 +416,6 @@ class SmallLabel(QtGui.QLabel):
         super(SmallLabel, self).__init__(parent)
         self.data = data
         self.initUI()
-        self.imageScaleRatio = 1
         # self.setPixmap(QtGui.QPixmap(self.originalSize[0],
         #                              self.originalSize[1]))
         self.generateInitialImage()
@@ -363,26 +423,6 @@ class SmallLabel(QtGui.QLabel):
     def initUI(self):
         self.setAlignment(QtCore.Qt.AlignTop)
 
-    def setImage(self, cv_image):
-        """Displays an image in the label.
-
-        Keyword Arguments:
-        cv_image -- OpenCV2 image, represented as a numpy array"""
-
-        if cv_image.ndim == 2:
-            cv_image = cv2.cvtColor(cv_image, cv2.cv.CV_GRAY2BGRA)
-        else:
-            cv_image = cv2.cvtColor(cv_image, cv2.cv.CV_BGR2BGRA)
-        originalSize = (cv_image.shape[1], cv_image.shape[0])
-        (w, h, rat) = computeImageScaleFactor(
-            originalSize, self.getCurrentSize())
-        self.imageScaleRatio = rat
-        cv_image = cv2.resize(cv_image, (w, h))
-        img = QtGui.QImage(cv_image, cv_image.shape[1], cv_image.shape[0],
-                           cv_image.strides[0], QtGui.QImage.Format_ARGB32)
-
-        self.setPixmap(QtGui.QPixmap.fromImage(img))
-
     def newResizeScale(self, scale):
         """Notifies the label that it should resize.
 
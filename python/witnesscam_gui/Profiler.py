@@ -0,0 +1,185 @@
+# Frame time profiler
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from collections import deque
+from timeit import default_timer
+import threading
+import numpy as np
+
+
+class FrameProfiler:
+    """Records how long each named stage of the frame pipeline takes.
+
+    The last WINDOW durations of every stage are kept, so the percentiles
+    follow the recent behaviour of the station. Stages can also count dropped
+    frames. Recording is off unless the profiler is enabled, in which case a
+    span costs a single function call."""
+
+    WINDOW = 600
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        """Constructor"""
+
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all the recorded timings"""
+
+        with self.lock:
+            self.order = []
+            self.samples = dict()
+            self.counts = dict()
+            self.drops = dict()
+
+    def enable(self, enabled=True):
+        """Turn recording on or off"""
+
+        self.enabled = enabled
+
+    def forked(self):
+        """Called first thing in a forked process. The lock may have been
+        copied while another thread held it, so it is replaced, and recording
+        is turned off since the timings of the child are never collected"""
+
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        """Time a stage of the pipeline, used as
+
+            with PROFILER.span('blur'):
+                ...
+
+        Keyword Arguments:
+        name -- name of the stage"""
+
+        if not self.enabled:
+            return NULL_SPAN
+        return ProfilerSpan(self, name)
+
+    def addStage(self, name):
+        """Start keeping track of a stage. Must hold the lock"""
+
+        if name not in self.samples:
+            self.order.append(name)
+            self.samples[name] = deque(maxlen=FrameProfiler.WINDOW)
+            self.counts[name] = 0
+            self.drops[name] = 0
+
+    def record(self, name, seconds):
+        """Record the duration of a stage.
+
+        Keyword Arguments:
+        name -- name of the stage
+        seconds -- how long the stage took"""
+
+        with self.lock:
+            self.addStage(name)
+            self.samples[name].append(seconds)
+            self.counts[name] += 1
+
+    def drop(self, name, n=1):
+        """Count frames dropped by a stage.
+
+        Keyword Arguments:
+        name -- name of the stage
+        n -- number of frames dropped"""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            self.addStage(name)
+            self.drops[name] += n
+
+    def stats(self):
+        """Summarize the recorded timings.
+
+        Return: list of (name, count, p50, p95, p99, drops) for each stage, in
+            the order the stages were first seen, with times in milliseconds"""
+
+        with self.lock:
+            rows = []
+            for name in self.order:
+                samples = np.array(self.samples[name])*1000
+                if len(samples) > 0:
+                    p = np.percentile(samples, FrameProfiler.PERCENTILES)
+                else:
+                    p = [0]*len(FrameProfiler.PERCENTILES)
+                rows.append((name, self.counts[name]) + tuple(p) +
+                            (self.drops[name],))
+            return rows
+
+    def format(self):
+        """Return: the summary of the timings as a fixed width text table"""
+
+        lines = ['%-10s %7s %7s %7s %7s %6s' %
+                 ('stage', 'count', 'p50', 'p95', 'p99', 'drops')]
+        for (name, count, p50, p95, p99, drops) in self.stats():
+            lines.append('%-10s %7d %7.2f %7.2f %7.2f %6d' %
+                         (name, count, p50, p95, p99, drops))
+        return '\n'.join(lines)
+
+    def dump(self, logger):
+        """Write the summary of the timings to a CSV file through the logger.
+
+        Keyword Arguments:
+        logger -- Util.InteractionLogger instance"""
+
+        logger.logTable(
+            'timings',
+            ['stage', 'count', 'p50_ms', 'p95_ms', 'p99_ms', 'drops'],
+            [(name, count, '%.3f' % p50, '%.3f' % p95, '%.3f' % p99, drops)
+             for (name, count, p50, p95, p99, drops) in self.stats()])
+
+
+class ProfilerSpan(object):
+    """Context manager timing one stage"""
+
+    __slots__ = ['profiler', 'name', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, default_timer()-self.start)
+        return False
+
+
+class NullSpan(object):
+    """Context manager used when the profiler is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+# The profiler shared by the whole application
+PROFILER = FrameProfiler()
@@ -0,0 +1,256 @@
+# Parallel regression tests over recorded camera sessions
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from time import time
+import multiprocessing
+import traceback
+import json
+import glob
+import sys
+import os
+import numpy as np
+
+from Util import InteractionLogger, TestingData, boxIntersectionOverUnion
+from Replay import ReplayEngine
+
+IOU_THRESHOLD = 0.5
+IOU_PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def matchBoxes(found, expected, threshold=IOU_THRESHOLD):
+    """Pair up the found boxes with the expected ones. The pairs with the
+    largest intersection over union are matched first, and each box is in at
+    most one pair.
+
+    Keyword Arguments:
+    found -- list of the found boxes (x1,y1,x2,y2)
+    expected -- list of the expected boxes (x1,y1,x2,y2)
+    threshold -- smallest intersection over union of a matched pair
+
+    Return: list of (found index, expected index, iou) for each pair"""
+
+    if len(found) == 0 or len(expected) == 0:
+        return []
+
+    iou = np.array([boxIntersectionOverUnion(expected, b) for b in found])
+    (usedFound, usedExpected) = (set(), set())
+    pairs = []
+    for k in np.argsort(-iou, axis=None):
+        (i, j) = np.unravel_index(k, iou.shape)
+        if iou[i, j] < threshold:
+            break
+        if i not in usedFound and j not in usedExpected:
+            usedFound.add(i)
+            usedExpected.add(j)
+            pairs.append((int(i), int(j), float(iou[i, j])))
+
+    return pairs
+
+
+def resolveTestingPaths(testdata, base):
+    """Make the paths of a testing file relative to the directory it is in.
+
+    Keyword Arguments:
+    testdata -- Util.TestingData instance
+    base -- directory of the testing file"""
+
+    for attr in ['camfile', 'trayfile', 'csvfile', 'checkcsvfile']:
+        path = getattr(testdata, attr)
+        if path:
+            setattr(testdata, attr, os.path.join(base, path))
+
+    # The events file of a synthetic camera is the only path inside its
+    # settings
+    if testdata.synthetic is not None and testdata.synthetic.get('events'):
+        testdata.synthetic = dict(testdata.synthetic)
+        testdata.synthetic['events'] = os.path.join(
+            base, testdata.synthetic['events'])
+
+
+def runSession(job):
+    """Replay one testing file and compare the boxes found with the checked
+    ones. Runs in a worker process of the pool.
+
+    Keyword Arguments:
+    job -- (path, overrides, threshold) of the testing file, the calibration
+        values to use instead of those of the file, and the smallest
+        intersection over union of a matching box
+
+    Return: dictionary with the results of the session"""
+
+    (path, overrides, threshold) = job
+    result = {'test': path, 'error': None}
+    start = time()
+    try:
+        testdata = TestingData.loadTestingFile(path)
+        resolveTestingPaths(testdata, os.path.dirname(path))
+        testdata.calibration = dict(testdata.calibration)
+        testdata.calibration.update(overrides)
+
+        engine = ReplayEngine(testdata, InteractionLogger())
+        found = engine.run().getStaticBoxes().tolist()
+        expected = testdata.loadCSVBoxes(testdata.checkcsvfile)
+        if expected is None:
+            raise IOError('Cannot read %s' % testdata.checkcsvfile)
+        expected = expected.getStaticBoxes().tolist()
+
+        pairs = matchBoxes(found, expected, threshold)
+        result.update({
+            'frames': engine.frames,
+            'replay_seconds': engine.elapsed,
+            'found': len(found),
+            'expected': len(expected),
+            'matched': len(pairs),
+            'precision': len(pairs)/float(len(found)) if found else None,
+            'recall': len(pairs)/float(len(expected)) if expected else None,
+            'ious': [iou for (_, _, iou) in pairs]})
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['wall_seconds'] = time() - start
+
+    return result
+
+
+def summarize(values, percentiles=IOU_PERCENTILES):
+    """Return: dictionary with the mean and percentiles of a list of values,
+    or None if it is empty"""
+
+    if len(values) == 0:
+        return None
+    p = np.percentile(values, percentiles)
+    summary = dict(('p%d' % q, float(v)) for (q, v) in zip(percentiles, p))
+    summary['mean'] = float(np.mean(values))
+    return summary
+
+
+def runRegression(paths, overrides=None, processes=None,
+                  threshold=IOU_THRESHOLD):
+    """Replay testing files in parallel and aggregate the results.
+
+    Keyword Arguments:
+    paths -- list of testing file paths
+    overrides -- dictionary of calibration values to use instead of those of
+        the testing files, eg. {'GRAY_THRESHOLD': 25}
+    processes -- number of worker processes, or None for one per core
+    threshold -- smallest intersection over union of a matching box
+
+    Return: dictionary with the results of each session and the totals"""
+
+    overrides = overrides if overrides is not None else dict()
+    start = time()
+
+    # Each worker only replays a single session, so the calibration values
+    # set on WitnessCam by one session cannot leak into the next
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        sessions = pool.map(runSession,
+                            [(p, overrides, threshold) for p in paths],
+                            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    ok = [s for s in sessions if s['error'] is None]
+    found = sum(s['found'] for s in ok)
+    expected = sum(s['expected'] for s in ok)
+    matched = sum(s['matched'] for s in ok)
+    summary = {
+        'sessions': len(sessions),
+        'failed': len(sessions) - len(ok),
+        'found': found,
+        'expected': expected,
+        'matched': matched,
+        'precision': matched/float(found) if found > 0 else None,
+        'recall': matched/float(expected) if expected > 0 else None,
+        'iou': summarize([iou for s in ok for iou in s['ious']]),
+        'session_seconds': summarize([s['wall_seconds'] for s in sessions]),
+        'wall_seconds': time() - start}
+
+    return {'overrides': overrides, 'iou_threshold': threshold,
+            'summary': summary, 'sessions': sessions}
+
+
+def parseOverride(text):
+    """Parse a NAME=VALUE calibration override.
+
+    Return: (name, value) with the value converted to a number"""
+
+    (name, value) = text.split('=', 1)
+    try:
+        value = int(value)
+    except ValueError:
+        value = float(value)
+    return (name, value)
+
+
+def main():
+    """Run the regression tests of a directory of testing files:
+
+        $ python2.7 Regression.py <dir> [-o report.json] [-j processes]
+              [-c NAME=VALUE ...] [-i iou_threshold]"""
+
+    directory = None
+    reportfile = None
+    processes = None
+    threshold = IOU_THRESHOLD
+    overrides = dict()
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-o':
+            reportfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-j':
+            processes = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-c':
+            (name, value) = parseOverride(sys.argv[i+1])
+            try:
+                overrides[name] = ReplayEngine.calibrationValue(name, value)
+            except ValueError as e:
+                sys.exit(str(e))
+            i += 2
+        elif sys.argv[i] == '-i':
+            threshold = float(sys.argv[i+1])
+            i += 2
+        else:
+            directory = sys.argv[i]
+            i += 1
+
+    if directory is None:
+        sys.exit(main.__doc__)
+
+    paths = sorted(glob.glob(os.path.join(directory, '*.test')))
+    report = runRegression(paths, overrides, processes, threshold)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if reportfile is not None:
+        with open(reportfile, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    s = report['summary']
+    sys.stderr.write('%d sessions, %d failed, %d/%d boxes matched\n'
+                     % (s['sessions'], s['failed'], s['matched'],
+                        s['expected']))
+
+
+if __name__ == '__main__':
+    main()
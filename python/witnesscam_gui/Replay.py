@@ -0,0 +1,200 @@
+# Headless replay of recorded camera sessions
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from time import time
+import cv2
+
+from Pt import Pt
+from Util import BugBoxList, computeImageScaleFactor
+from CameraFeed import DownscalePlan, openTestingCamera
+from TrayImage import TrayImageCache, TrayRenderer
+from GUIParts import BigLabel, SmallLabel
+from WitnessCam import WitnessCam
+from AppData import AppData
+
+
+class ReplayEngine:
+    """Runs the detection logic of WitnessCam over the recorded camera video,
+    or the synthetic camera, of a testing file, as fast as the frames can be
+    processed.
+
+    No widgets or timers are created. The tray corners of the testing file are
+    applied before the first frame, the calibration values are applied
+    directly, and every frame of the video is processed, so the result of a
+    replay only depends on the testing file."""
+
+    DIAGNOSTICS_HEADER = ['Frame', 'Time ms', 'Process ms', 'Phase',
+                          'Stable run', 'Stable box run', 'Frame diff',
+                          'Smooth delta', 'Centroid x', 'Centroid y',
+                          'Removed box', 'Boxes']
+
+    def __init__(self, testdata, logger, use_worker=False,
+                 label_size=BigLabel.originalSize):
+        """Constructor
+
+        Keyword Arguments:
+        testdata -- Util.TestingData of the recorded session
+        logger -- Util.InteractionLogger instance
+        use_worker -- whether to compute the frame difference in a separate
+            process
+        label_size -- (width, height) of the big label the tray corners of
+            the testing file were clicked on"""
+
+        self.testdata = testdata
+        self.logger = logger
+        self.labelSize = label_size
+        self.cvImpl = WitnessCam(
+            logger, None, use_worker,
+            (AppData.CAM_MAX_HEIGHT, AppData.CAM_MAX_WIDTH))
+        self.frames = 0
+        self.elapsed = 0
+
+    def applyCalibration(self, calibration):
+        """Set the algorithm constants of WitnessCam.
+
+        Keyword Arguments:
+        calibration -- dictionary from constant names to values"""
+
+        for (name, value) in calibration.items():
+            value = ReplayEngine.calibrationValue(name, value)
+            setattr(WitnessCam, name, value)
+            self.logger.log('CALIBRATE set %s to %s' % (name, str(value)), 0)
+
+    @staticmethod
+    def calibrationValue(name, value):
+        """Convert a calibration value to the type of the WitnessCam constant
+        it is for. Values that would change, such as a fraction for an
+        integer constant, are rejected rather than rounded.
+
+        Keyword Arguments:
+        name -- name of the constant
+        value -- the value to set it to
+
+        Return: the converted value"""
+
+        if not hasattr(WitnessCam, name):
+            raise ValueError('Unknown WitnessCam constant %s' % name)
+        kind = type(getattr(WitnessCam, name))
+        converted = kind(value)
+        if converted != value:
+            raise ValueError('%s must be of type %s, not %s'
+                             % (name, kind.__name__, str(value)))
+        return converted
+
+    def run(self, diagnostics_fname=None):
+        """Replay the session.
+
+        Keyword Arguments:
+        diagnostics_fname -- path of a CSV file to write the per frame
+            diagnostics to, or None
+
+        Return: Util.BugBoxList of the boxes found"""
+
+        td = self.testdata
+        wc = self.cvImpl
+        tray = TrayRenderer(TrayImageCache(
+            cv2.imread(td.trayfile, cv2.IMREAD_COLOR)))
+        boxes = td.loadCSVBoxes(td.csvfile)
+        if boxes is None:
+            boxes = BugBoxList()
+        self.applyCalibration(td.calibration)
+
+        capture = openTestingCamera(td)
+        fps = capture.get(cv2.cv.CV_CAP_PROP_FPS)
+        fps = fps if fps > 0 else 30
+        maxSize = (AppData.CAM_MAX_WIDTH, AppData.CAM_MAX_HEIGHT)
+        plan = None
+        bigSize = self.labelSize
+        smallSize = SmallLabel.originalSize
+
+        rows = []
+        self.frames = 0
+        start = time()
+        try:
+            while True:
+                (ok, frame) = capture.read()
+                if not ok or frame is None:
+                    break
+                if plan is None or plan.shape != frame.shape:
+                    plan = DownscalePlan(frame.shape, maxSize)
+                frame = plan.apply(frame)
+
+                if self.frames == 0:
+                    self.startScanning(frame)
+                elif td.rununtil is not None and \
+                        self.frames*1000.0/fps > td.rununtil:
+                    break
+
+                t0 = time()
+                (_, _, boxes) = wc.amendFrame(frame, tray, bigSize,
+                                              smallSize, boxes)
+                t1 = time()
+
+                if diagnostics_fname is not None:
+                    rows.append(self.diagnostics(
+                        self.frames*1000.0/fps, (t1-t0)*1000, len(boxes)))
+                self.frames += 1
+        finally:
+            capture.release()
+            wc.shutdown()
+        self.elapsed = time() - start
+
+        self.logger.log('REPLAY %d frames in %f seconds'
+                        % (self.frames, self.elapsed), 0)
+        if diagnostics_fname is not None:
+            with open(diagnostics_fname, 'w') as f:
+                f.write(', '.join(ReplayEngine.DIAGNOSTICS_HEADER) + '\n')
+                for r in rows:
+                    f.write(', '.join('' if v is None else str(v)
+                                      for v in r) + '\n')
+
+        return boxes
+
+    def startScanning(self, frame):
+        """Select the tray area from the corners of the testing file and go
+        straight into scanning mode, using the frame as the background.
+
+        Keyword Arguments:
+        frame -- the first camera frame"""
+
+        wc = self.cvImpl
+        (h, w) = frame.shape[0:2]
+        (_, _, rat) = computeImageScaleFactor((w, h), self.labelSize)
+        wc.cameraImage = frame
+        wc.setTrayArea([Pt(int(x/rat), int(y/rat))
+                        for [x, y] in self.testdata.traycorners])
+        wc.phase = WitnessCam.SCANNING_MODE
+        wc.refreshCamera()
+
+    def diagnostics(self, ms, process_ms, nboxes):
+        """Return: the diagnostics row of the last processed frame
+
+        Keyword Arguments:
+        ms -- time of the frame in the video, in milliseconds
+        process_ms -- time it took to process the frame, in milliseconds
+        nboxes -- number of placed boxes"""
+
+        wc = self.cvImpl
+        c = wc.lastMedpos
+        return (self.frames, '%.1f' % ms, '%.3f' % process_ms, wc.phase,
+                wc.stableRun, wc.stableBoxRun,
+                wc.activeFrameCurrentDiff, wc.activeFrameSmoothDelta,
+                c.x if c is not None else None,
+                c.y if c is not None else None,
+                wc.removedBug, nboxes)
@@ -0,0 +1,277 @@
+# Synthetic camera
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from time import time
+import numpy as np
+import cv2
+
+from Util import TestingData
+from TrayImage import TrayImageCache
+
+
+class SyntheticCamera:
+    """Stand-in for cv2.VideoCapture that renders the camera view of a tray
+    scan, so the application can be run and timed without a camera.
+
+    The tray is warped into the frame with a known homography, and insects
+    are removed and put back following a script. Every frame gets a random
+    brightness change, pixel noise and a small shift of the whole view. The
+    random values come from a seeded generator, so the frames are the same on
+    every run. Each scripted action is recorded as a ground truth event, with
+    the box of the insect in the tray scan and in the camera frame."""
+
+    # Corners of the tray in the frame, as fractions of the frame size
+    CORNERS = [(0.15, 0.10), (0.85, 0.12), (0.88, 0.90), (0.12, 0.88)]
+    BACKGROUND = (60, 70, 80)
+    NOISE_FRAMES = 8
+
+    EVENTS_HEADER = ['Frame', 'Time ms', 'Wall time', 'Action', 'Insect Id',
+                     'Rectangle x1', 'y1', 'x2', 'y2', 'Camera x1', 'y1',
+                     'x2', 'y2']
+
+    def __init__(self, tray, boxes, size=(640, 480), fps=30, corners=None,
+                 script=None, frames=None, noise=2.0, flicker=0.01,
+                 jitter=0.0, seed=0, events_fname=None):
+        """Constructor
+
+        Keyword Arguments:
+        tray -- the full resolution tray scan
+        boxes -- Util.BugBoxList of the insects on the tray
+        size -- (width, height) of the frames
+        fps -- frame rate reported to the capture loop
+        corners -- list of the four tray corners (x,y) in the frame, in the
+            order of the corners of the tray scan starting from the top left,
+            or None for the default
+        script -- list of (frame, action, insect) where action is 'remove' or
+            'replace', and insect is the name or index of a box
+        frames -- number of frames before the stream ends, or None to never
+            end
+        noise -- standard deviation of the pixel noise
+        flicker -- standard deviation of the relative brightness change
+        jitter -- standard deviation of the shift of the view in pixels
+        seed -- seed of the random generator
+        events_fname -- path of a CSV file to write the events to as they
+            happen, or None"""
+
+        self.size = tuple(size)
+        self.fps = float(fps)
+        self.frames = frames
+        self.noise = noise
+        self.flicker = flicker
+        self.jitter = jitter
+        self.rng = np.random.RandomState(seed)
+        self.boxes = boxes
+        self.eventsFile = None
+        if events_fname is not None:
+            self.eventsFile = open(events_fname, 'w')
+            self.eventsFile.write(
+                ', '.join(SyntheticCamera.EVENTS_HEADER) + '\n')
+
+        # Render from the level of the tray scan closest to the frame size
+        (w, h) = self.size
+        (th, tw) = tray.shape[0:2]
+        (self.original, self.scale) = TrayImageCache(tray).getLevel((w, h))
+        self.tray = np.copy(self.original)
+        self.fill = np.median(self.original.reshape(-1, 3), axis=0)
+
+        if corners is None:
+            corners = [(u*w, v*h) for (u, v) in SyntheticCamera.CORNERS]
+        self.corners = [(float(x), float(y)) for (x, y) in corners]
+        src = np.float32([[0, 0], [tw, 0], [tw, th], [0, th]])
+        self.homography = cv2.getPerspectiveTransform(
+            src, np.float32(self.corners))
+        s = self.scale
+        self.levelHomography = self.homography.dot(
+            np.diag([1.0/s, 1.0/s, 1.0]))
+
+        self.script = sorted(
+            (int(f), action, self.boxIndex(b))
+            for (f, action, b) in (script if script is not None else []))
+        self.nextAction = 0
+        self.removed = set()
+        self.events = []
+
+        self.frame = np.empty((h, w, 3), np.uint8)
+        self.work = np.empty((h, w, 3), np.int16)
+        self.noiseFrames = [
+            self.rng.normal(0, noise, (h, w, 3)).round().astype(np.int16)
+            for i in range(SyntheticCamera.NOISE_FRAMES)]
+        self.index = 0
+        self.opened = True
+
+    @staticmethod
+    def fromConfig(config, tray_fname, csv_fname):
+        """Create a synthetic camera from the 'synthetic' object of a testing
+        file.
+
+        Keyword Arguments:
+        config -- dictionary with the keyword arguments of the constructor,
+            where each script entry is {"frame", "action", "box"}, and
+            "events" is the events file
+        tray_fname -- path of the tray scan
+        csv_fname -- path of the CSV file with the boxes of the insects"""
+
+        config = dict(config)
+        boxes = TestingData.loadCSVBoxes(csv_fname)
+        if boxes is None:
+            raise IOError('Cannot read %s' % csv_fname)
+        tray = cv2.imread(tray_fname, cv2.IMREAD_COLOR)
+        if tray is None:
+            raise IOError('Cannot read %s' % tray_fname)
+
+        script = [(a['frame'], a['action'], a['box'])
+                  for a in config.pop('script', [])]
+        events = config.pop('events', None)
+        return SyntheticCamera(tray, boxes, script=script, events_fname=events,
+                               **config)
+
+    def boxIndex(self, box):
+        """Return: the index of a box given by its name or index"""
+
+        if isinstance(box, int):
+            return box
+        return list(self.boxes.getNames()).index(box)
+
+    def liveBox(self, static):
+        """Return: the bounding box (x1,y1,x2,y2) in the frame of a box in the
+        tray scan, without the jitter"""
+
+        (x1, y1, x2, y2) = static
+        pts = np.float64([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
+        pts = cv2.perspectiveTransform(pts.reshape(-1, 1, 2),
+                                       self.homography).reshape(-1, 2)
+        (u1, v1) = pts.min(axis=0)
+        (u2, v2) = pts.max(axis=0)
+        return (int(u1), int(v1), int(u2), int(v2))
+
+    def act(self, action, i):
+        """Remove an insect from the tray, or put it back.
+
+        Keyword Arguments:
+        action -- 'remove' or 'replace'
+        i -- index of the box of the insect"""
+
+        s = self.scale
+        (h, w) = self.tray.shape[0:2]
+        static = tuple(self.boxes.getStaticBoxes()[i])
+        (x1, y1, x2, y2) = static
+        (x1, y1) = (max(int(x1*s), 0), max(int(y1*s), 0))
+        (x2, y2) = (min(int(x2*s)+1, w), min(int(y2*s)+1, h))
+
+        if action == 'remove':
+            self.tray[y1:y2, x1:x2] = self.fill
+            self.removed.add(i)
+        elif action == 'replace':
+            self.tray[y1:y2, x1:x2] = self.original[y1:y2, x1:x2]
+            self.removed.discard(i)
+        else:
+            raise ValueError('Unknown synthetic camera action %s' % action)
+
+        event = (self.index, self.index*1000.0/self.fps, time(), action,
+                 self.boxes.getNames()[i], static, self.liveBox(static))
+        self.events.append(event)
+        if self.eventsFile is not None:
+            (f, ms, wall, action, name, static, live) = event
+            self.eventsFile.write(
+                '%d, %.1f, %f, %s, %s, %d, %d, %d, %d, %d, %d, %d, %d\n'
+                % ((f, ms, wall, action, name) + static + live))
+            self.eventsFile.flush()
+
+    def grab(self):
+        """Render the next frame.
+
+        Return: False once the stream has ended, True otherwise"""
+
+        if not self.opened or \
+                (self.frames is not None and self.index >= self.frames):
+            return False
+
+        while self.nextAction < len(self.script) and \
+                self.script[self.nextAction][0] <= self.index:
+            (_, action, i) = self.script[self.nextAction]
+            self.act(action, i)
+            self.nextAction += 1
+
+        # Warp the tray with the view shifted a little
+        (dx, dy) = self.rng.normal(0, self.jitter, 2) if self.jitter > 0 \
+            else (0, 0)
+        shift = np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]])
+        self.frame[...] = SyntheticCamera.BACKGROUND
+        cv2.warpPerspective(self.tray, shift.dot(self.levelHomography),
+                            self.size, self.frame, cv2.INTER_LINEAR,
+                            cv2.BORDER_TRANSPARENT)
+
+        # Lighting change and pixel noise
+        gain = 1 + self.rng.normal(0, self.flicker)
+        noise = self.noiseFrames[
+            self.rng.randint(SyntheticCamera.NOISE_FRAMES)]
+        np.multiply(self.frame, gain, out=self.work, casting='unsafe')
+        np.add(self.work, noise, out=self.work)
+        np.clip(self.work, 0, 255, out=self.work)
+        self.frame[...] = self.work
+
+        self.index += 1
+        return True
+
+    def retrieve(self, image=None):
+        """Get the last rendered frame.
+
+        Keyword Arguments:
+        image -- array to copy the frame into, or None for a new one
+
+        Return: (ok, image)"""
+
+        if self.index == 0:
+            return (False, None)
+        if image is None or image.shape != self.frame.shape:
+            return (True, np.copy(self.frame))
+        image[...] = self.frame
+        return (True, image)
+
+    def read(self, image=None):
+        """Render the next frame and get it.
+
+        Return: (ok, image)"""
+
+        if not self.grab():
+            return (False, None)
+        return self.retrieve(image)
+
+    def get(self, prop):
+        """Get a property of the stream, like cv2.VideoCapture.get(..)"""
+
+        (w, h) = self.size
+        values = {cv2.cv.CV_CAP_PROP_FPS: self.fps,
+                  cv2.cv.CV_CAP_PROP_FRAME_WIDTH: w,
+                  cv2.cv.CV_CAP_PROP_FRAME_HEIGHT: h,
+                  cv2.cv.CV_CAP_PROP_FRAME_COUNT: self.frames or 0,
+                  cv2.cv.CV_CAP_PROP_POS_FRAMES: self.index,
+                  cv2.cv.CV_CAP_PROP_POS_MSEC: self.index*1000.0/self.fps}
+        return float(values.get(prop, 0))
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        """End the stream"""
+
+        self.opened = False
+        if self.eventsFile is not None:
+            self.eventsFile.close()
+            self.eventsFile = None
@@ -0,0 +1,319 @@
+# Tray scan image module
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+from Util import computeImageScaleFactor
+import Constants as C
+
+
+class TrayImageCache:
+    """Holds the loaded tray scan, along with a pyramid of smaller copies of
+    it, and the copies already scaled to fit the labels it was last shown in.
+
+    Tray scans are much larger than the labels they are shown in, so all of
+    the per frame drawing is done on the copy at display resolution, with the
+    box coordinates scaled to it."""
+
+    MIN_LEVEL_SIZE = 64
+
+    # Number of scaled copies kept. Resizing a window asks for a new size on
+    # every step, so only the most recently used ones are kept
+    MAX_LEVELS = 3
+
+    def __init__(self, image):
+        """Constructor
+
+        Keyword Arguments:
+        image -- the full resolution tray scan"""
+
+        self.image = image
+        self.shape = image.shape
+
+        # Each pyramid level is half the size of the previous one
+        self.pyramid = [image]
+        while min(self.pyramid[-1].shape[0:2]) > 2*self.MIN_LEVEL_SIZE:
+            self.pyramid.append(cv2.pyrDown(self.pyramid[-1]))
+
+        self.levels = OrderedDict()
+
+    def size(self):
+        """Return: the (width, height) of the full resolution tray scan"""
+
+        return (self.shape[1], self.shape[0])
+
+    def getLevel(self, box):
+        """Get the tray scan scaled to fit in a label.
+
+        Keyword Arguments:
+        box -- the (width, height) of the label
+
+        Return: (image, scale)
+        image -- the scaled tray scan. It is shared, so it should be copied
+            before drawing on it
+        scale -- the factor that scales full resolution tray coordinates to
+            the coordinates of the scaled image"""
+
+        (w, h, rat) = computeImageScaleFactor(self.size(), box)
+        if (w, h) in self.levels:
+            # Mark it as the most recently used
+            self.levels[(w, h)] = self.levels.pop((w, h))
+        else:
+            # Start from the smallest level that is still big enough
+            src = self.pyramid[0]
+            for level in self.pyramid:
+                if level.shape[1] >= w and level.shape[0] >= h:
+                    src = level
+
+            self.levels[(w, h)] = (
+                cv2.resize(src, (w, h), interpolation=cv2.INTER_AREA), rat)
+            while len(self.levels) > TrayImageCache.MAX_LEVELS:
+                self.levels.popitem(last=False)
+
+        return self.levels[(w, h)]
+
+
+class TrayRenderer:
+    """Draws the box markers on the tray scan at display resolution.
+
+    The tray image with all the markers drawn on it is kept as a layer, and
+    only the regions of markers that changed since the last frame are
+    redrawn. The BugBoxList version tells when the boxes may have changed.
+    Each frame only copies the layer into the frame buffer."""
+
+    DRAW_DELTA = 10
+    FULL_REDRAW_COUNT = 32
+
+    def __init__(self, tray):
+        """Constructor
+
+        Keyword Arguments:
+        tray -- TrayImageCache of the loaded tray scan"""
+
+        self.tray = tray
+        self.background = None
+        self.scale = None
+        self.layer = None
+        self.frame = None
+
+        self.state = None
+        self.items = []
+        self.extents = np.zeros((0, 4), np.int32)
+        self.selected = None
+
+    def size(self):
+        """Return: the (width, height) of the full resolution tray scan"""
+
+        return self.tray.size()
+
+    def getLevel(self, box):
+        """Same as TrayImageCache.getLevel(..)"""
+
+        return self.tray.getLevel(box)
+
+    def setSelectedBox(self, i):
+        """Set the box selected for editing.
+
+        Keyword Arguments:
+        i -- index of the selected box, or None"""
+
+        self.selected = i
+
+    def render(self, box, boxes, removed):
+        """Get the tray scan with all the markers drawn on it.
+
+        Keyword Arguments:
+        box -- the (width, height) of the label the tray is shown in
+        boxes -- Util.BugBoxList of the placed boxes
+        removed -- index of the box of the removed insect, or -1
+
+        Return: (image, scale)
+        image -- frame buffer with the tray and markers. It can be drawn on,
+            and is overwritten by the next call to render(..)
+        scale -- the factor that scales full resolution tray coordinates to
+            the coordinates of the image"""
+
+        (level, scale) = self.tray.getLevel(box)
+        if level is not self.background:
+            # The label changed size, so start over at the new level
+            self.background = level
+            self.scale = scale
+            self.layer = np.copy(level)
+            self.frame = np.empty_like(level)
+            self.items = []
+            self.extents = np.zeros((0, 4), np.int32)
+            self.state = None
+
+        state = (id(boxes), boxes.version, removed, self.selected)
+        if state != self.state:
+            self.state = state
+            self.update(boxes, removed)
+
+        np.copyto(self.frame, self.layer)
+        return (self.frame, self.scale)
+
+    def update(self, boxes, removed):
+        """Redraw the regions of the markers that changed.
+
+        Keyword Arguments:
+        boxes -- Util.BugBoxList of the placed boxes
+        removed -- index of the box of the removed insect, or -1"""
+
+        items = self.buildItems(boxes, removed)
+        old = set(self.items)
+        new = set(items)
+        changed = [it for it in self.items if it not in new] + \
+            [it for it in items if it not in old]
+
+        self.items = items
+        if len(items) > 0:
+            self.extents = np.array([self.itemExtent(it) for it in items],
+                                    np.int32)
+        else:
+            self.extents = np.zeros((0, 4), np.int32)
+
+        (h, w) = self.layer.shape[0:2]
+        if len(changed) > TrayRenderer.FULL_REDRAW_COUNT:
+            self.redraw((0, 0, w, h))
+        else:
+            for it in changed:
+                (x1, y1, x2, y2) = self.itemExtent(it)
+                (x1, y1) = (max(x1, 0), max(y1, 0))
+                (x2, y2) = (min(x2, w), min(y2, h))
+                if x1 < x2 and y1 < y2:
+                    self.redraw((x1, y1, x2, y2))
+
+    def buildItems(self, boxes, removed):
+        """Build the list of markers to draw.
+
+        Keyword Arguments:
+        boxes -- Util.BugBoxList of the placed boxes
+        removed -- index of the box of the removed insect, or -1
+
+        Return: list of (name, box, point, removed, selected) tuples, with the
+            box and point in layer coordinates"""
+
+        s = self.scale
+        statics = (boxes.getStaticBoxes()*s).astype(int).tolist()
+        points = (boxes.getPoints()*s).astype(int).tolist()
+        names = boxes.getNames()
+        return [(names[i] if i == removed or i == self.selected else None,
+                 tuple(statics[i]), tuple(points[i]), i == removed,
+                 i == self.selected)
+                for i in range(len(boxes))]
+
+    def itemExtent(self, item):
+        """The area of the layer a marker is drawn in.
+
+        Keyword Arguments:
+        item -- (name, box, point, removed, selected) marker tuple
+
+        Return: (x1,y1,x2,y2) with (x2,y2) exclusive"""
+
+        (name, b, (px, py), removed, selected) = item
+        a = TrayRenderer.DRAW_DELTA
+        t = max(a//5, 1)
+        (x1, y1, x2, y2) = (px-a, py-a, px+a, py+a)
+        if removed or selected:
+            ((tw, th), base) = cv2.getTextSize(
+                name, cv2.FONT_HERSHEY_SIMPLEX, a/18.0, t)
+            # The box, the delete button, and the ID below the box
+            x1 = min(x1, b[0], b[2], b[2]-3*a, b[0]-a//2)
+            y1 = min(y1, b[1], b[3])
+            x2 = max(x2, b[0], b[2], b[0]-a//2+tw)
+            y2 = max(y2, b[1], b[3], b[1]+3*a, b[3]+th+base)
+        pad = a//2 + t
+        return (x1-pad, y1-pad, x2+pad+1, y2+pad+1)
+
+    def redraw(self, rect):
+        """Restore the background in a region of the layer, and draw the
+        markers overlapping it.
+
+        The markers are drawn whole on a copy of the background that covers
+        all of them, and only the region is copied back. Drawing them clipped
+        to the region would not give exactly the same pixels for thick lines.
+
+        Keyword Arguments:
+        rect -- (x1,y1,x2,y2) region with (x2,y2) exclusive"""
+
+        (x1, y1, x2, y2) = rect
+        e = self.extents
+        hit = np.flatnonzero((e[:, 0] < x2) & (e[:, 2] > x1) &
+                             (e[:, 1] < y2) & (e[:, 3] > y1))
+        if len(hit) == 0:
+            self.layer[y1:y2, x1:x2] = self.background[y1:y2, x1:x2]
+            return
+
+        (h, w) = self.layer.shape[0:2]
+        u1 = max(min(x1, e[hit, 0].min()), 0)
+        v1 = max(min(y1, e[hit, 1].min()), 0)
+        u2 = min(max(x2, e[hit, 2].max()), w)
+        v2 = min(max(y2, e[hit, 3].max()), h)
+        scratch = np.copy(self.background[v1:v2, u1:u2])
+        for i in hit:
+            self.drawItem(scratch, (u1, v1), self.items[i])
+        self.layer[y1:y2, x1:x2] = scratch[y1-v1:y2-v1, x1-u1:x2-u1]
+
+    def drawItem(self, image, offset, item):
+        """Draw a single marker.
+
+        Keyword Arguments:
+        image -- the image to draw on
+        offset -- (x,y) position of the image in the layer
+        item -- (name, box, point, removed, selected) marker tuple"""
+
+        (name, b, (px, py), removed, selected) = item
+        (ox, oy) = offset
+        b = (b[0]-ox, b[1]-oy, b[2]-ox, b[3]-oy)
+        (px, py) = (px-ox, py-oy)
+        a = TrayRenderer.DRAW_DELTA
+        t = max(a//5, 1)
+
+        # Draw the removed bug box slightly different
+        if removed:
+            ((_, h), _) = cv2.getTextSize(
+                name, cv2.FONT_HERSHEY_SIMPLEX, a/18.0, t)
+            cv2.putText(image, name, (b[0]-a//2, b[3]+h),
+                        cv2.FONT_HERSHEY_SIMPLEX, a/18.0, C.WHITE, t)
+            cv2.rectangle(image, b[0:2], b[2:4], C.BLUE, t)
+            col = C.BLUE
+        elif selected:
+            col = C.RED
+        else:
+            col = C.GREEN
+
+        # Draw the box of the box selected for editing, with its delete
+        # button and ID
+        if selected:
+            cv2.rectangle(image, b[0:2], b[2:4], C.RED, t)
+            cv2.rectangle(image, (b[2]-a, b[1]+3*a), (b[2]-3*a, b[1]+a),
+                          C.RED, t)
+            cv2.line(image, (b[2]-a, b[1]+3*a), (b[2]-3*a, b[1]+a), C.RED, t)
+            cv2.line(image, (b[2]-3*a, b[1]+3*a), (b[2]-a, b[1]+a), C.RED, t)
+            ((_, h), _) = cv2.getTextSize(
+                name, cv2.FONT_HERSHEY_SIMPLEX, a/18.0, t)
+            cv2.putText(image, name, (b[0]-a//2, b[3]+h),
+                        cv2.FONT_HERSHEY_SIMPLEX, a/18.0, C.WHITE, t)
+
+        # Draw the circle marker on each insect
+        cv2.line(image, (px, py-a), (px, py+a), col, t)
+        cv2.line(image, (px+a, py), (px-a, py), col, t)
+        cv2.circle(image, (px, py), a, col, t)
@@ -20,6 +20,7 @@
 from Pt import *
 from time import time
 from PySide import QtTest, QtCore
+import numpy as np
 import json
 import os
 import csv
@@ -56,7 +57,8 @@ def buildPolygonSquareModel(points):
         from the top-left
 
     Return: model
-    model -- a tuple containing the individual coefficents"""
+    model -- a PolygonSquareModel, a tuple containing the individual
+        coefficents along with the equivalent homographies"""
 
     [p0, p1, p2, p3] = points
     [p00, p01, p02, p03] = [p0-p0, p1-p0, p2-p0, p3-p0]
@@ -75,7 +77,7 @@ def buildPolygonSquareModel(points):
     G = GG-1
     H = HH-1
 
-    return (p0, A, B, C, D, E, F, G, H)
+    return PolygonSquareModel((p0, A, B, C, D, E, F, G, H))
 
 
 def poly2square(model, scalex, scaley, pos):
@@ -91,13 +93,9 @@ def poly2square(model, scalex, scaley, pos):
     Return: point
     point -- the corresponding point inside the rectangle"""
 
-    (p0, A, B, C, D, E, F, G, H) = model
-    (x, y) = (pos.x-p0.x, pos.y-p0.y)
-
-    v = (-A*F+A*y+C*D-C*G*y-D*x+F*G*x)/(A*E-A*H*y-B*D+B*G*y+D*H*x-E*G*x)
-    u = (-C-B*v+x+H*v*x)/(A-G*x)
+    (u, v, w) = model.inverse.dot((pos.x, pos.y, 1.0))
 
-    return Pt(int(u*scalex), int(v*scaley))
+    return Pt(int(u/w*scalex), int(v/w*scaley))
 
 
 def square2poly(model, scalex, scaley, pos):
@@ -122,6 +120,104 @@ def square2poly(model, scalex, scaley, pos):
     return Pt(int(x), int(y))
 
 
+def poly2squareArray(model, scalex, scaley, pts):
+    """Maps an array of points inside a quadrilateral to points on a
+    rectangle. This is the same mapping as poly2square(..) applied to each
+    point.
+
+    Keyword Arguments:
+    model -- a polygon-square model produced by buildPolygonSquareModel(..)
+    scalex -- the width of the rectangle that the points are getting mapped
+    scaley -- the height of the rectangle that the points are getting mapped
+    pts -- Nx2 array of (x,y) points inside the polygon
+
+    Return: points
+    points -- Nx2 int array of the corresponding points inside the rectangle"""
+
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    (u, v, w) = model.inverse.dot(
+        np.column_stack((pts, np.ones(len(pts)))).T)
+
+    return np.column_stack((u/w*scalex, v/w*scaley)).astype(int)
+
+
+def square2polyArray(model, scalex, scaley, pts):
+    """Maps an array of points inside a rectangle to points on a
+    quadrilateral. This is the same mapping as square2poly(..) applied to each
+    point.
+
+    Keyword Arguments:
+    model -- a polygon-square model produced by buildPolygonSquareModel(..)
+    scalex -- the width of the rectangle that the points are located on
+    scaley -- the height of the rectangle that the points are located on
+    pts -- Nx2 array of (x,y) points inside the rectangle
+
+    Return: points
+    points -- Nx2 int array of the corresponding points on the quadrilateral"""
+
+    (p0, A, B, C, D, E, F, G, H) = model
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    u = pts[:, 0]/float(scalex)
+    v = pts[:, 1]/float(scaley)
+
+    x = (A*u+B*v+C)/(G*u+H*v+1) + p0.x
+    y = (D*u+E*v+F)/(G*u+H*v+1) + p0.y
+
+    return np.column_stack((x, y)).astype(int)
+
+
+def square2polyHomography(model, scalex, scaley):
+    """Returns the 3x3 homography matrix equivalent to square2poly(..), for use
+    with functions such as cv2.perspectiveTransform or cv2.warpPerspective.
+    The inverse of the matrix is equivalent to poly2square(..).
+
+    Keyword Arguments:
+    model -- a polygon-square model produced by buildPolygonSquareModel(..)
+    scalex -- the width of the rectangle
+    scaley -- the height of the rectangle
+
+    Return: matrix
+    matrix -- 3x3 float64 array mapping rectangle points to the polygon"""
+
+    (p0, A, B, C, D, E, F, G, H) = model
+    unit = np.array([[A+G*p0.x, B+H*p0.x, C+p0.x],
+                     [D+G*p0.y, E+H*p0.y, F+p0.y],
+                     [G, H, 1]], dtype=np.float64)
+    return unit.dot(np.diag([1.0/scalex, 1.0/scaley, 1.0]))
+
+
+class PolygonSquareModel(tuple):
+    """A polygon-square model produced by buildPolygonSquareModel(..). It is a
+    tuple of the individual coefficents, and also holds the forward and
+    inverse homographies between the unit square and the quadrilateral. The
+    homographies scaled to an image size, from toPolygon(..) and
+    toSquare(..), can be passed to cv2.warpPerspective(..) to warp whole
+    images between the two."""
+
+    def __new__(cls, coefficients):
+        """Constructor
+
+        Keyword Arguments:
+        coefficients -- the tuple (p0, A, B, C, D, E, F, G, H)"""
+
+        model = tuple.__new__(cls, coefficients)
+        model.homography = square2polyHomography(model, 1, 1)
+        model.inverse = np.linalg.inv(model.homography)
+        return model
+
+    def toPolygon(self, scalex, scaley):
+        """Returns the 3x3 homography mapping points on a rectangle of size
+        (scalex, scaley) to the quadrilateral."""
+
+        return self.homography.dot(np.diag([1.0/scalex, 1.0/scaley, 1.0]))
+
+    def toSquare(self, scalex, scaley):
+        """Returns the 3x3 homography mapping points on the quadrilateral to a
+        rectangle of size (scalex, scaley)."""
+
+        return np.diag([scalex, scaley, 1.0]).dot(self.inverse)
+
+
 def quadrilateralArea(points):
     """Compute the area of a convex quadrilateral.
 
@@ -163,59 +259,35 @@ def findWeightedMedianPoint2D(image, roi):
     Return: point
     point -- the point Pt(x,y) of the median of the grayscale intensity"""
 
-    totalIntensity = 0.0
-    xlist = []
-    ylist = []
-    area = (roi[1].x - roi[0].x)*(roi[1].y-roi[0].y)
-    step = int(math.sqrt(area)/50)
-    for x in range(roi[0].x, roi[1].x, step):
-        for y in range(roi[0].y, roi[1].y, step):
-            if image[y, x] > 0:
-                totalIntensity += image[y, x]
-                xlist.append((x, image[y, x]))
-                ylist.append((y, image[y, x]))
-
-    if xlist and ylist:
-        return Pt(weightedMedian1D(xlist), weightedMedian1D(ylist))
+    # The median of each coordinate only depends on the marginal distribution
+    # of the intensity along that axis
+    region = image[roi[0].y:roi[1].y, roi[0].x:roi[1].x]
+    xweights = region.sum(axis=0, dtype=np.float64)
+    yweights = region.sum(axis=1, dtype=np.float64)
+
+    x = weightedMedian1D(xweights)
+    y = weightedMedian1D(yweights)
+    if x is not None and y is not None:
+        return Pt(roi[0].x + x, roi[0].y + y)
 
     return None
 
 
-def weightedMedian1D(lst):
-    """Finds the median position/50th percentile of the elements in the list.
+def weightedMedian1D(weights):
+    """Finds the median position/50th percentile of a distribution of weights.
 
     Keyword Arguments:
-    lst -- the list of values (i, mag) where 'i' is the cooridinate and 'mag'
-        is the weight at that coordinate
+    weights -- 1D numpy array, where weights[i] is the weight at coordinate i
 
     Return: pos
-    pos -- the coordinate in the list where the median is located"""
-
-    lst.sort()
-
-    # Convert distribution of weights into cumulative distribution
-    for i in range(1, len(lst)):
-        (cord, weight) = lst[i]
-        (_, prev_weight) = lst[i-1]
-        lst[i] = (cord, weight+prev_weight)
-
-    # Binary search for the mid value in the cumulative distribution
-    if lst:
-        xmed = lst[-1][1]/2
-        low = 0
-        high = len(lst)-1
-        while (high-low > 1):
-            check = int(math.floor((high+low)/2))
-            (v, w) = lst[check]
-            if w > xmed:
-                high = check
-            elif w < xmed:
-                low = check
-            else:
-                low = check
-                high = check
-                break
-        return lst[high][0]
+    pos -- the coordinate where the median is located, or None if there is no
+        weight in the distribution"""
+
+    cumulative = np.cumsum(weights)
+    if len(cumulative) == 0 or cumulative[-1] <= 0:
+        return None
+
+    return int(np.searchsorted(cumulative, cumulative[-1]/2.0))
 
 
 def getOverlappingBox(boxes, box, threshold=0.5):
@@ -236,27 +308,44 @@ def getOverlappingBox(boxes, box, threshold=0.5):
         box in 'boxes'"""
 
     (x1, y1, x2, y2) = box
-    i = 0
-    for b in boxes:
-        (u1, v1, u2, v2) = b
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    (u1, v1, u2, v2) = boxes.T
 
-        if not (x1 > u2 or u1 > x2 or y1 > v2 or v1 > y2):
-            a = max(x1, u1)
-            b = max(y1, v1)
-            c = min(x2, u2)
-            d = min(y2, v2)
-            overlap_area = abs(a-c)*abs(b-d)
-            total_area = (u2-u1)*(v2-v1)
-            perc = overlap_area/float(total_area)
+    intersects = ~((x1 > u2) | (u1 > x2) | (y1 > v2) | (v1 > y2))
+    overlap_area = np.abs(np.maximum(x1, u1)-np.minimum(x2, u2)) *\
+        np.abs(np.maximum(y1, v1)-np.minimum(y2, v2))
+    total_area = (u2-u1)*(v2-v1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perc = overlap_area/total_area
 
-            # Only consider overlapping if more than 50% of the test box
-            # overlaps this one
-            if perc >= threshold:
-                return i
+    # Only consider overlapping if more than 50% of the test box overlaps
+    # this one
+    found = np.flatnonzero(intersects & (perc >= threshold))
+    return int(found[0]) if len(found) > 0 else -1
 
-        i += 1
 
-    return -1
+def boxIntersectionOverUnion(boxes, box):
+    """Computes the intersection over union of a box with each box of a list.
+
+    Keyword Arguments:
+    boxes -- list of boxes (x1,y1,x2,y2)
+    box -- the box (x1,y1,x2,y2) to compare with
+
+    Return: iou
+    iou -- numpy array with the intersection over union [0,1] of the box with
+        each of the boxes"""
+
+    (x1, y1, x2, y2) = box
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    (u1, v1, u2, v2) = boxes.T
+
+    w = np.maximum(np.minimum(x2, u2) - np.maximum(x1, u1), 0)
+    h = np.maximum(np.minimum(y2, v2) - np.maximum(y1, v1), 0)
+    intersection = w*h
+    union = (x2-x1)*(y2-y1) + (u2-u1)*(v2-v1) - intersection
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(union > 0, intersection/union, 0)
+    return iou
 
 
 def pointInBox(p, box):
@@ -310,10 +399,73 @@ def changeExtension(fname, ext):
     return csvfile
 
 
-class BugBox:
+class BugBoxStore:
+    """Columnar storage for the data of many BugBox instances. Each insect is
+    a row in the arrays. The row of a box that is removed from its BugBoxList
+    is released, and reused by the next box that is added, so the arrays only
+    grow with the number of boxes in the list at once."""
+
+    def __init__(self, capacity=64):
+        """Constructor
+
+        Keyword Arguments:
+        capacity -- number of rows to allocate up front"""
+
+        self.count = 0
+        self.free = []
+        self.names = np.empty(capacity, dtype=object)
+        self.static = np.zeros((capacity, 4), np.int32)
+        self.live = np.zeros((capacity, 4), np.int32)
+        self.hasLive = np.zeros(capacity, np.bool_)
+        self.point = np.zeros((capacity, 2), np.int32)
+
+    def append(self, name, livebox, staticbox, pt):
+        """Add a row to the store and return its index."""
+
+        if len(self.free) > 0:
+            row = self.free.pop()
+        else:
+            if self.count == len(self.names):
+                self.grow(2*len(self.names))
+            row = self.count
+            self.count += 1
+
+        self.names[row] = name
+        self.static[row] = staticbox
+        self.hasLive[row] = livebox is not None
+        if livebox is not None:
+            self.live[row] = livebox
+        self.point[row] = pt
+        return row
+
+    def release(self, row):
+        """Free a row so that it can be reused by append(..)"""
+
+        self.names[row] = None
+        self.free.append(row)
+
+    def grow(self, capacity):
+        """Reallocate the arrays to hold 'capacity' rows"""
+
+        for attr in ['names', 'static', 'live', 'hasLive', 'point']:
+            old = getattr(self, attr)
+            new = np.zeros((capacity,) + old.shape[1:], old.dtype)
+            if old.dtype == object:
+                new[:] = None
+            new[0:len(old)] = old
+            setattr(self, attr, new)
+
+
+class BugBox(object):
     """This class holds the data for one insect and its corresponding point and
     box. The static box is where the insect is in the loaded image, while the
-    live box is where the insect appears in the camera view"""
+    live box is where the insect appears in the camera view
+
+    While the box is in a BugBoxList, its data lives in a row of the store of
+    the list, so that operations on all the boxes of the list can work on
+    whole arrays. Otherwise the data is held by the instance itself"""
+
+    __slots__ = ['store', 'row', '_name', '_live', '_static', '_point']
 
     def __init__(self, name, livebox, staticbox, pt):
         """Constructor
@@ -326,10 +478,101 @@ class BugBox:
         pt -- (x,y) ints representing the position of the insect in the
             tray scan"""
 
-        self.name = name
-        self.live = livebox
-        self.static = staticbox
-        self.point = pt
+        self.store = None
+        self.row = None
+        self._name = name
+        self._live = BugBox.intTuple(livebox)
+        self._static = BugBox.intTuple(staticbox)
+        self._point = BugBox.intTuple(pt)
+
+    @staticmethod
+    def intTuple(values):
+        """Return: the values as a tuple of ints, or None"""
+
+        if values is None:
+            return None
+        return tuple(int(v) for v in values)
+
+    def attach(self, store):
+        """Move the data of this box into a row of a store.
+
+        Keyword Arguments:
+        store -- the BugBoxStore instance"""
+
+        if self.store is not store:
+            if self.store is not None:
+                self.detach()
+            self.row = store.append(self._name, self._live, self._static,
+                                    self._point)
+            self.store = store
+            (self._name, self._live, self._static, self._point) = \
+                (None, None, None, None)
+
+    def detach(self):
+        """Move the data of this box out of its store, and release its row"""
+
+        if self.store is not None:
+            (self._name, self._live, self._static, self._point) = \
+                (self.name, self.live, self.static, self.point)
+            self.store.release(self.row)
+            self.store = None
+            self.row = None
+
+    @property
+    def name(self):
+        if self.store is None:
+            return self._name
+        return self.store.names[self.row]
+
+    @name.setter
+    def name(self, name):
+        if self.store is None:
+            self._name = name
+        else:
+            self.store.names[self.row] = name
+
+    @property
+    def live(self):
+        if self.store is None:
+            return self._live
+        if not self.store.hasLive[self.row]:
+            return None
+        return tuple(self.store.live[self.row].tolist())
+
+    @live.setter
+    def live(self, livebox):
+        if self.store is None:
+            self._live = BugBox.intTuple(livebox)
+            return
+        self.store.hasLive[self.row] = livebox is not None
+        if livebox is not None:
+            self.store.live[self.row] = livebox
+
+    @property
+    def static(self):
+        if self.store is None:
+            return self._static
+        return tuple(self.store.static[self.row].tolist())
+
+    @static.setter
+    def static(self, staticbox):
+        if self.store is None:
+            self._static = BugBox.intTuple(staticbox)
+        else:
+            self.store.static[self.row] = staticbox
+
+    @property
+    def point(self):
+        if self.store is None:
+            return self._point
+        return tuple(self.store.point[self.row].tolist())
+
+    @point.setter
+    def point(self, pt):
+        if self.store is None:
+            self._point = BugBox.intTuple(pt)
+        else:
+            self.store.point[self.row] = pt
 
     def __str__(self):
         """Convert BugBox to a string representation"""
@@ -371,6 +614,92 @@ class BugBox:
         except AttributeError:
             return False
 
+    def __ne__(s, o):
+        return not (s == o)
+
+    __hash__ = object.__hash__
+
+
+class BugBoxGrid:
+    """Uniform grid index over the static boxes of BugBox instances, so that
+    the boxes near a point or box can be found without scanning the whole
+    list. Boxes are stored by identity in every cell they overlap."""
+
+    CELL_SIZE = 128
+
+    def __init__(self, cell_size=CELL_SIZE):
+        """Constructor
+
+        Keyword Arguments:
+        cell_size -- width and height of a grid cell in tray image pixels"""
+
+        self.cellSize = cell_size
+        self.cells = dict()
+
+    def cellsFor(self, rect):
+        """Returns the list of (i,j) grid cells that a rectangle overlaps.
+
+        Keyword Arguments:
+        rect -- the rectangle (x1,y1,x2,y2)"""
+
+        (x1, y1, x2, y2) = rect
+        c = self.cellSize
+        (i1, i2) = (int(min(x1, x2))//c, int(max(x1, x2))//c)
+        (j1, j2) = (int(min(y1, y2))//c, int(max(y1, y2))//c)
+        return [(i, j) for i in range(i1, i2+1) for j in range(j1, j2+1)]
+
+    def insert(self, box, rect):
+        """Add a box to the grid.
+
+        Keyword Arguments:
+        box -- the BugBox instance
+        rect -- the static box (x1,y1,x2,y2) of the instance"""
+
+        for cell in self.cellsFor(rect):
+            self.cells.setdefault(cell, dict())[id(box)] = box
+
+    def remove(self, box, rect):
+        """Remove a box from the grid.
+
+        Keyword Arguments:
+        box -- the BugBox instance
+        rect -- the static box (x1,y1,x2,y2) the instance was inserted with"""
+
+        for cell in self.cellsFor(rect):
+            boxes = self.cells.get(cell)
+            if boxes is not None:
+                boxes.pop(id(box), None)
+                if not boxes:
+                    del self.cells[cell]
+
+    def move(self, box, old, new):
+        """Update the grid after the static box of an instance changed.
+
+        Keyword Arguments:
+        box -- the BugBox instance
+        old -- the previous static box (x1,y1,x2,y2)
+        new -- the new static box (x1,y1,x2,y2)"""
+
+        if self.cellsFor(old) != self.cellsFor(new):
+            self.remove(box, old)
+            self.insert(box, new)
+
+    def query(self, rect):
+        """Returns the boxes stored in the cells the rectangle overlaps. This
+        is a superset of the boxes that actually intersect the rectangle.
+
+        Keyword Arguments:
+        rect -- the rectangle (x1,y1,x2,y2)
+
+        Return: list of BugBox instances"""
+
+        found = dict()
+        for cell in self.cellsFor(rect):
+            boxes = self.cells.get(cell)
+            if boxes is not None:
+                found.update(boxes)
+        return list(found.values())
+
 
 class BugBoxList:
     """Class that manage a list of BugBox instances. While
@@ -473,6 +802,11 @@ class BugBoxList:
         self.boxes = []
         self.undoStack = []
         self.redoStack = []
+        self.version = 0
+        self.store = BugBoxStore()
+        self.rows = None
+        self.grid = BugBoxGrid()
+        self.positions = dict()
 
     def newBox(self, box):
         """Add a new box to the list.
@@ -482,7 +816,12 @@ class BugBoxList:
 
         self.recordAction(BugBoxList.Action.newBox(len(self.boxes)),
                           self.undoStack)
+        box.attach(self.store)
         self.boxes.append(box)
+        self.rows = None
+        self.grid.insert(box, box.static)
+        if self.positions is not None:
+            self.positions[id(box)] = len(self.boxes)-1
         if box.live is None:
             self.recomputeLiveBoxes = True
 
@@ -497,13 +836,54 @@ class BugBoxList:
         if i is None:
             return self.recomputeLiveBoxes
         elif i < len(self.boxes):
-            return self.boxes[i].live is None
+            return not self.store.hasLive[self.boxes[i].row]
 
     def recomputedLiveBoxes(self):
         """Notifies that all invalid live boxes have been fixed"""
 
         self.recomputeLiveBoxes = False
 
+    def getRows(self):
+        """Returns the rows of the store holding the boxes, in list order"""
+
+        if self.rows is None:
+            self.rows = np.array([b.row for b in self.boxes], dtype=np.intp)
+        return self.rows
+
+    def getNames(self):
+        """Returns an array of the names of all the boxes"""
+
+        return self.store.names[self.getRows()]
+
+    def getStaticBoxes(self):
+        """Returns an Nx4 array of the static boxes of all the boxes"""
+
+        return self.store.static[self.getRows()]
+
+    def getLiveBoxes(self):
+        """Returns an Nx4 array of the live boxes of all the boxes, along with
+        an array that is False for the boxes that have no live box."""
+
+        rows = self.getRows()
+        return (self.store.live[rows], self.store.hasLive[rows])
+
+    def getPoints(self):
+        """Returns an Nx2 array of the points of all the boxes"""
+
+        return self.store.point[self.getRows()]
+
+    def setLiveBoxes(self, indices, liveboxes):
+        """Set the live boxes of many boxes at once. Like setting the live
+        attribute directly, this is not recorded for undo.
+
+        Keyword Arguments:
+        indices -- positions in the list of the boxes to set
+        liveboxes -- Nx4 array of the new live boxes"""
+
+        rows = self.getRows()[indices]
+        self.store.live[rows] = liveboxes
+        self.store.hasLive[rows] = True
+
     def __getitem__(self, index):
         """Allow array element access"""
         return self.boxes[index]
@@ -522,12 +902,76 @@ class BugBoxList:
     def __repr__(self):
         return str(self)
 
+    def indexOf(self, box):
+        """Returns the position of a BugBox instance in the list.
+
+        Keyword Arguments:
+        box -- BugBox instance in the list"""
+
+        # Positions shift when boxes are removed or inserted, so they are
+        # rebuilt lazily after those changes
+        if self.positions is None:
+            self.positions = dict(
+                (id(b), i) for (i, b) in enumerate(self.boxes))
+        return self.positions[id(box)]
+
+    def query(self, rect):
+        """Returns the indices of the boxes whose static box intersects the
+        rectangle, in list order.
+
+        Keyword Arguments:
+        rect -- the rectangle (x1,y1,x2,y2)
+
+        Return: list of indices"""
+
+        (x1, y1, x2, y2) = rect
+        found = []
+        for b in self.grid.query(rect):
+            (u1, v1, u2, v2) = b.static
+            if not (x1 > max(u1, u2) or min(u1, u2) > x2 or
+                    y1 > max(v1, v2) or min(v1, v2) > y2):
+                found.append(self.indexOf(b))
+        found.sort()
+        return found
+
+    def getOverlappingBox(self, box, threshold=0.5):
+        """Same as Util.getOverlappingBox(..), using the grid to only test the
+        boxes near the test box.
+
+        Keyword Arguments:
+        box -- the box (x1,y1,x2,y2) that we are checking for overlap with
+        threshold -- the percentage of overlap [0,1] to consider the test box
+            overlapping
+
+        Return: index
+        index -- the first box in the list that overlaps the test box
+             (-1 if no box overlaps)"""
+
+        near = self.query(box)
+        i = getOverlappingBox(self.getStaticBoxes()[near], box, threshold)
+        return near[i] if i != -1 else -1
+
     def getDict(self):
         box_dict = dict()
         for b in self.boxes:
             box_dict[b.name] = b
         return box_dict
 
+    def writeCSV(self, fname):
+        """Write the boxes to a CSV file, in the format the tray CSV files are
+        loaded from.
+
+        Keyword Arguments:
+        fname -- path of the CSV file"""
+
+        with open(fname, "w") as f:
+            f.write("Insect Id, Rectangle x1, y1, x2, y1, Point x, y\n")
+            rows = zip(self.getNames(), self.getStaticBoxes().tolist(),
+                       self.getPoints().tolist())
+            for (name, (x1, y1, x2, y2), (px, py)) in rows:
+                f.write("%s, %d, %d, %d, %d, %d, %d\n"
+                        % (name, x1, y1, x2, y2, px, py))
+
     def delete(self, index):
         """Deletes the box at the index position from the list.
 
@@ -538,6 +982,10 @@ class BugBoxList:
         self.recordAction(BugBoxList.Action.deleteBox(index, box),
                           self.undoStack)
         del self.boxes[index]
+        self.grid.remove(box, box.static)
+        box.detach()
+        self.positions = None
+        self.rows = None
 
     def changeBox(self, index, name=None, live=None, static=None, point=None):
         """Change the box at the index position to have the new values
@@ -562,6 +1010,7 @@ class BugBoxList:
         if live is not None:
             self.boxes[index].live = live
         if static is not None:
+            self.grid.move(self.boxes[index], self.boxes[index].static, static)
             self.boxes[index].static = static
         if point is not None:
             self.boxes[index].point = point
@@ -577,6 +1026,9 @@ class BugBoxList:
         allow_merge -- whether it should be possible to merge this action with
             the one on the top of the stack"""
 
+        # Every change to the boxes is recorded, so this is where the version
+        # is bumped for anything that caches them
+        self.version += 1
         if len(stack) == 0 or not allow_merge or not stack[-1].merge(action):
             stack.append(action)
             if clear_redo:
@@ -599,14 +1051,23 @@ class BugBoxList:
             return None
 
         if act.action == BugBoxList.Action.CREATE_BOX:
+            box = self.boxes[act.index]
             self.recordAction(BugBoxList.Action.deleteBox(
-                act.index, self.boxes[act.index]), stack2, False, False)
+                act.index, box), stack2, False, False)
             del self.boxes[act.index]
+            self.grid.remove(box, box.static)
+            box.detach()
+            self.positions = None
+            self.rows = None
             return -1
         elif act.action == BugBoxList.Action.DELETE_BOX:
             self.recordAction(BugBoxList.Action.newBox(act.index),
                               stack2, False, False)
+            act.box.attach(self.store)
             self.boxes.insert(act.index, act.box)
+            self.grid.insert(act.box, act.box.static)
+            self.positions = None
+            self.rows = None
             return act.index
         elif act.action == BugBoxList.Action.TRANSFORM_BOX_FROM:
             i = act.index
@@ -619,6 +1080,8 @@ class BugBoxList:
                 point=box.point if act.point is not None else None),
                 stack2, False, False)
             box.name = act.name if act.name is not None else box.name
+            if act.static is not None:
+                self.grid.move(box, box.static, act.static)
             box.static = act.static if act.static is not None else box.static
             box.live = act.live if act.live is not None else box.live
             box.point = act.point if act.point is not None else box.point
@@ -659,6 +1122,26 @@ class InteractionLogger:
             self.loggingFile.write(
                 str(time() - self.startTime) + " " + string + "\n")
 
+    def logTable(self, name, header, rows):
+        """Write a table to a CSV file next to the log file, named after the
+        log file and the table. Nothing is written if there is no log file.
+
+        Keyword Arguments:
+        name -- name of the table
+        header -- list of column names
+        rows -- list of rows, each a list of values"""
+
+        if self.filename is None:
+            return
+
+        fname = '%s.%s.csv' % (os.path.splitext(self.filename)[0], name)
+        with open(fname, 'w') as f:
+            f.write(', '.join(header) + '\n')
+            for row in rows:
+                f.write(', '.join(str(v) for v in row) + '\n')
+        self.log('TABLE %s written to %s' % (name, fname))
+
+
 class TestingData:
     @staticmethod
     def loadTestingFile(testfile):
@@ -681,13 +1164,14 @@ class TestingData:
 
     def __init__(self, jd):
         self.automate = jd['automate']
-        self.camfile = jd['camfile']
+        self.camfile = jd.get('camfile')
         self.trayfile = jd['trayfile']
         self.csvfile = jd['csvfile']
         self.checkcsvfile = jd['check-csvfile']
         self.traycorners = jd['traycorners']
         self.calibration = jd['calibration']
         self.rununtil = jd['rununtil']
+        self.synthetic = jd.get('synthetic')
 
 
     def setMainTestingWindow(self, win):
@@ -728,7 +1212,8 @@ class TestingData:
                     error += 1
         print('%d errors found in regression test' % error)
 
-    def loadCSVBoxes(self, csv_fname):
+    @staticmethod
+    def loadCSVBoxes(csv_fname):
         boxes = None
         if os.path.isfile(csv_fname):
             with open(csv_fname) as csvfile:
@@ -19,12 +19,16 @@
 
 from PySide import QtCore, QtGui
 from functools import partial
+from time import time
 import numpy as np
 import cv2
 
 from Pt import *
 from Util import *
 from GUIParts import SimplePlotter
+from FrameDifference import FrameDifferenceEngine, TrayMaskCache
+from DifferenceWorker import DifferenceWorker, DifferenceWorkerError
+from Profiler import PROFILER
 import Constants as C
 
 
@@ -51,12 +55,19 @@ class WitnessCam(QtCore.QObject):
     FRAME_DELTA_BLENDING_FACTOR = 1.0
     STABLE_FRAME_DELTA_THRESHOLD = 0.4
     STABLE_FRAME_ACTION_THRESHOLD = 0.5
+    TIMINGS_INTERVAL = 1.0
 
-    def __init__(self, logger, tester):
-        """Constructor.
+    def __init__(self, logger, tester, use_worker=False, max_frame_shape=None):
+        """Constructor. The worker process is started here, so this should be
+        called before the camera capture thread is started.
 
         Keyword Arguments:
-        logger -- a Util.InteractionLogger instance"""
+        logger -- a Util.InteractionLogger instance
+        tester -- a Util.TestingData instance, or None
+        use_worker -- whether to compute the frame difference in a separate
+            process
+        max_frame_shape -- (height, width) of the largest camera frame the
+            worker will be given, needed if use_worker is True"""
 
         super(WitnessCam, self).__init__()
 
@@ -64,6 +75,13 @@ class WitnessCam(QtCore.QObject):
         self.mainWindow = None
         self.calibrate = None
         self.testdata = tester
+        self.differenceEngine = FrameDifferenceEngine()
+        self.trayMask = TrayMaskCache()
+        self.backgroundVersion = 0
+        self.useWorker = use_worker
+        self.differenceWorker = None
+        if use_worker:
+            self.differenceWorker = DifferenceWorker(max_frame_shape)
         self.reset()
 
     def setMainWindow(self, win):
@@ -101,7 +119,7 @@ class WitnessCam(QtCore.QObject):
         self.cameraImage = None
         self.logger.log('INIT WitnessCam class', 0)
 
-    def amendFrame(self, camera_frame, static_frame, big_scale, small_scale,
+    def amendFrame(self, camera_frame, tray, big_size, small_size,
                    placed_boxes):
         """Takes the raw (resized) camera frame, and the plain tray image and
         modifies it for display to the user, as well as updating the internal
@@ -109,14 +127,15 @@ class WitnessCam(QtCore.QObject):
 
         Keywords Arguments:
         camera_frame -- image from camera as numpy array
-        static_frame -- loaded tray scan image
-        big_scale -- float scale of the camera_frame
-        small_scale -- float scale of the static_frame
+        tray -- TrayImage.TrayRenderer of the loaded tray scan image
+        big_size -- (width, height) of the big label
+        small_size -- (width, height) of the small label
         placed_boxes -- Util.BugBoxList instance
 
-        Return: (camera_frame, static_frame, placed_boxes)
-        camera_frame -- the processed frame from the camera view
-        static_frame -- the amended tray image
+        Return: (big_image, small_image, placed_boxes)
+        big_image -- (image, scale) to show in the big label, where scale
+            is the factor from image coordinates to full resolution ones
+        small_image -- (image, scale) to show in the small label
         placed_boxes -- Util.BigBoxList instance"""
 
         self.cameraImage = camera_frame
@@ -124,12 +143,16 @@ class WitnessCam(QtCore.QObject):
         # No need to modify the passed in images
         camera_frame_algo = np.copy(camera_frame)
         camera_frame_show = np.copy(camera_frame)
-        static_frame = np.copy(static_frame)
 
-        # Setup drawing variables
+        # Setup drawing variables. The tray is drawn on at the resolution it
+        # is displayed at, so its drawing length is unscaled
         (mx, my) = self.mousePos
+        cameraSize = (camera_frame.shape[1], camera_frame.shape[0])
+        (_, _, big_scale) = computeImageScaleFactor(cameraSize, big_size)
+        (_, _, small_scale) = computeImageScaleFactor(cameraSize, small_size)
         dB = int(WitnessCam.DRAW_DELTA/big_scale)
         dS = int(WitnessCam.DRAW_DELTA/small_scale)
+        dT = WitnessCam.DRAW_DELTA
 
         if self.phase == WitnessCam.SELECT_POLYGON:
             # Draw the cursor on the image
@@ -142,37 +165,39 @@ class WitnessCam(QtCore.QObject):
             for p in self.polyPoints:
                 cv2.circle(camera_frame_show, (p.x, p.y), int(dB*0.6), C.GREEN)
 
-            return (camera_frame_show, static_frame, placed_boxes)
+            return ((camera_frame_show, 1.0), tray.getLevel(small_size),
+                    placed_boxes)
 
         elif self.phase == WitnessCam.CALIBRATION:
 
             # Continue to update intern state while calibration is happening
             (camera_frame_algo, centroid) =\
                 self.getFrameDifferenceCentroid(camera_frame_algo)
-            return (static_frame, camera_frame_algo, placed_boxes)
+            return (tray.getLevel(big_size), (camera_frame_algo, 1.0),
+                    placed_boxes)
 
         elif self.phase == WitnessCam.SCANNING_MODE:
+            (trayWidth, trayHeight) = tray.size()
 
             # If the boxes were just loaded or created, then the live boxes are
             # dirty and need to be recalculated
             if self.rescalePlacedBoxes\
                     or placed_boxes.shouldRecomputeLiveBoxes():
-                for i in range(len(placed_boxes)):
-                    if self.rescalePlacedBoxes\
-                            or placed_boxes.shouldRecomputeLiveBoxes(i):
-                        (x, y) = placed_boxes[i].point
-                        (x1, y1, x2, y2) = placed_boxes[i].static
-
-                        (h, w, _) = static_frame.shape
-                        p1 = square2poly(self.polygon_model, w, h, Pt(x1, y1))
-                        p2 = square2poly(self.polygon_model, w, h, Pt(x1, y2))
-                        p3 = square2poly(self.polygon_model, w, h, Pt(x2, y2))
-                        p4 = square2poly(self.polygon_model, w, h, Pt(x2, y1))
-                        x1 = min(p1.x, p2.x, p3.x, p4.x)
-                        x2 = max(p1.x, p2.x, p3.x, p4.x)
-                        y1 = min(p1.y, p2.y, p3.y, p4.y)
-                        y2 = max(p1.y, p2.y, p3.y, p4.y)
-                        placed_boxes[i].live = (x1, y1, x2, y2)
+                if self.rescalePlacedBoxes:
+                    dirty = np.arange(len(placed_boxes))
+                else:
+                    dirty = np.flatnonzero(~placed_boxes.getLiveBoxes()[1])
+
+                if len(dirty) > 0:
+                    # Map the corners of all the dirty static boxes at once
+                    corners = placed_boxes.getStaticBoxes()[dirty]
+                    corners = corners[:, [0, 1, 0, 3, 2, 3, 2, 1]]
+                    corners = square2polyArray(
+                        self.polygon_model, trayWidth, trayHeight,
+                        corners).reshape(-1, 4, 2)
+                    placed_boxes.setLiveBoxes(
+                        dirty, np.hstack((corners.min(axis=1),
+                                          corners.max(axis=1))))
 
                 self.rescalePlacedBoxes = False
                 placed_boxes.recomputedLiveBoxes()
@@ -181,30 +206,35 @@ class WitnessCam(QtCore.QObject):
             # position in the camera frame
             (camera_frame_algo, centroid) =\
                 self.getFrameDifferenceCentroid(camera_frame_algo)
+
+            # The renderer keeps the markers of all the placed boxes drawn, so
+            # only what changes every frame is drawn on top of it
+            with PROFILER.span('drawing'):
+                (static_frame, static_scale) = tray.render(
+                    big_size, placed_boxes, self.removedBug)
             if centroid is not None:
 
                 # If an insect has been removed, find the corresponding insect
                 # in the tray image, and mark it
-                (trayHeight, trayWidth, _) = static_frame.shape
                 (u, v) = poly2square(self.polygon_model, trayWidth, trayHeight,
                                      centroid).t()
-                cv2.line(static_frame, (u-dB, v), (u+dB, v), C.RED,
-                         max(int(dB/5), 1))
-                cv2.line(static_frame, (u, v-dB), (u, v+dB), C.RED,
-                         max(int(dB/5), 1))
+                (u, v) = (int(u*static_scale), int(v*static_scale))
+                cv2.line(static_frame, (u-dT, v), (u+dT, v), C.RED,
+                         max(int(dT/5), 1))
+                cv2.line(static_frame, (u, v-dT), (u, v+dT), C.RED,
+                         max(int(dT/5), 1))
 
             # Once the camera view has been stable for a while, try to find box
             if self.stableRun >= WitnessCam.ACTION_DELAY:
-                self.findCorrectBox(centroid, camera_frame_algo, static_frame,
-                                    placed_boxes, dB)
+                self.findCorrectBox(centroid, camera_frame_algo, tray.size(),
+                                    static_frame, static_scale, placed_boxes,
+                                    dT)
 
             # Draw the outline of the tray area
             self.drawTrayArea(camera_frame_show, dS)
 
-            # Draw all the boxes that have already been placed
-            self.drawPlacedBoxes(static_frame, placed_boxes, C.GREEN, C.RED,
-                                 C.BLUE, dB)
-            return (static_frame, camera_frame_algo, placed_boxes)
+            return ((static_frame, static_scale), (camera_frame_algo, 1.0),
+                    placed_boxes)
 
     def allowEditing(self):
         """Returns whether the AppData class should allow editing of the placed
@@ -273,42 +303,47 @@ class WitnessCam(QtCore.QObject):
         frame -- processed grayscale frame
         centroid -- center of difference"""
 
-        # Setup a mask to block off certain parts of the difference image
-        (h, w, d) = frame.shape
-        polygon_mask = np.zeros((h, w, d), np.uint8)
-
-        poly = None
-        polyArea = -1
-        poly = np.array([[p.x, p.y] for p in self.polyPoints],
-                        dtype=np.int32)
-
-        # Block off the area outside the tray
-        polyArea = quadrilateralArea([(p.x, p.y) for p in self.polyPoints])
-        cv2.drawContours(polygon_mask, [poly], 0, (1, 1, 1), -1)
-
-        # Block off the box containing the removed insect
+        # Get the mask blocking off the area outside the tray, and the box
+        # containing the removed insect
+        selection = None
         if self.currentSelectionBox is not None:
-            b = self.currentSelectionBox.live
-            q0 = (int(b[0]), int(b[1]))
-            q1 = (int(b[2]), int(b[1]))
-            q2 = (int(b[2]), int(b[3]))
-            q3 = (int(b[0]), int(b[3]))
-            poly = np.array([q0, q1, q2, q3], dtype=np.int32)
-            polyArea = polyArea - quadrilateralArea([q0, q1, q2, q3])
-            cv2.drawContours(polygon_mask, [poly], 0, (0, 0, 0), -1)
+            selection = self.currentSelectionBox.live
+        (polygon_mask, polyArea) = self.trayMask.get(
+            frame.shape, self.polyPoints, selection)
 
         # Convert color image for current frame to grayscale image difference
         # and apply the mask to block off certain areas
-        frame = cv2.cvtColor(frame, cv2.cv.CV_BGR2Lab)
-        frame = np.absolute(np.subtract(self.camBackground.astype(int),
-                            frame.astype(int))).astype(np.uint8)
-        frame = np.add.reduce(np.square(np.multiply(
-                              np.float32(frame), polygon_mask)), 2)
-        frame = np.sqrt(frame)
-        frame = cv2.GaussianBlur(frame, (5, 5), 0)
-        frame = frame / math.sqrt(3)
-        frame[frame < WitnessCam.GRAY_THRESHOLD] = 0
-        tframe = np.copy(frame)
+        worker = self.differenceWorker
+        if worker is not None and not worker.fits(frame.shape):
+            worker = None
+        if worker is not None:
+            # The worker process also computes the sum and the median of the
+            # difference, but its results are one frame behind
+            key = (self.backgroundVersion, self.trayMask.key,
+                   WitnessCam.GRAY_THRESHOLD)
+            try:
+                if key != worker.key:
+                    worker.configure(key, self.camBackground, polygon_mask,
+                                     WitnessCam.GRAY_THRESHOLD,
+                                     self.trayBoundingBox)
+                result = worker.process(frame)
+            except DifferenceWorkerError as e:
+                # Carry on without the worker
+                self.logger.log('WORKER %s' % str(e), 0)
+                self.shutdown()
+                worker = None
+        if worker is not None:
+            if result is None:
+                return (np.zeros(frame.shape[0:2], np.uint8), None)
+            (frame, total, workerMedpos) = result
+            tframe = None
+        else:
+            # Only the tray bounding box is processed, tframe holds that
+            # region of the difference image
+            (tframe, frame, offset) = self.differenceEngine.compute(
+                frame, self.camBackground, polygon_mask,
+                WitnessCam.GRAY_THRESHOLD, self.trayBoundingBox)
+            total = np.sum(tframe)
 
         # Determine whether the frame has been stable for a while, and if it
         # has been, then compute the center of the difference in the frame.
@@ -319,7 +354,7 @@ class WitnessCam(QtCore.QObject):
             # Compute the total difference of this frame, and the change from
             # last frame to this one
             a = WitnessCam.FRAME_DELTA_BLENDING_FACTOR
-            self.activeFrameCurrentDiff = np.sum(tframe)/polyArea
+            self.activeFrameCurrentDiff = total/polyArea
             delta = self.activeFrameCurrentDiff - self.activeFrameLastDiff
             self.activeFrameSmoothDelta = \
                 (1-a)*self.activeFrameSmoothDelta + a*delta
@@ -336,9 +371,10 @@ class WitnessCam(QtCore.QObject):
                 self.stableBox = None
 
             # Update the calibration/debug gui with these debug values
-            self.calibrate.updateValues(
-                self.stableRun, self.stableBoxRun, self.activeFrameCurrentDiff,
-                self.activeFrameSmoothDelta)
+            if self.calibrate is not None:
+                self.calibrate.updateValues(
+                    self.stableRun, self.stableBoxRun,
+                    self.activeFrameCurrentDiff, self.activeFrameSmoothDelta)
 
             # If the frame has been stable for long enough, then
             # find the centroid of the frame difference
@@ -346,8 +382,15 @@ class WitnessCam(QtCore.QObject):
                     self.stableRun > WitnessCam.ACTION_DELAY and \
                     self.activeFrameCurrentDiff \
                     > WitnessCam.STABLE_FRAME_ACTION_THRESHOLD:
-                medpos = findWeightedMedianPoint2D(
-                    tframe, self.trayBoundingBox)
+                if tframe is None:
+                    medpos = workerMedpos
+                else:
+                    (p0, p1) = self.trayBoundingBox
+                    with PROFILER.span('median'):
+                        medpos = findWeightedMedianPoint2D(
+                            tframe, [p0-offset, p1-offset])
+                    if medpos is not None:
+                        medpos = medpos + offset
 
                 if self.lastMedpos is not None and medpos is not None:
                     (x0, y0) = self.lastMedpos.t()
@@ -358,54 +401,14 @@ class WitnessCam(QtCore.QObject):
                         self.stableBox = None
 
         else:
-            self.activeFrameLastDiff = np.sum(tframe)/polyArea
+            self.activeFrameLastDiff = total/polyArea
             self.activeFrameSmoothDelta = 0
 
         self.lastMedpos = medpos
-        frame = np.uint8(frame)
         return (frame, medpos)
 
-    def drawPlacedBoxes(self, image, boxes, regular, selected, active, a):
-        """Given an input image, draw all of the generated boxes on the image.
-        Optional colour paramaters can also be supplied.
-
-        Keyword Arguments:
-        image -- the numpy array image that the boxes will be drawn on
-        boxes -- the BugBoxList of the placed boxes
-        regular -- the colour of the boxes
-        selected -- the colour of the selected box for editing
-        active -- the color of the box for a removed bug
-        a -- a unit of drawing length
-        """
-
-        # Only need to draw while in SCANNING_MODE
-        if self.phase == WitnessCam.SCANNING_MODE:
-            for i in range(len(boxes)):
-
-                # Some drawing values
-                b = boxes[i].static
-                (px, py) = boxes[i].point
-                t = max(int(a/5), 1)
-                col = None
-
-                # Draw the removed bug box slightly different
-                if i == self.removedBug:
-                    col = active
-                    ((_, h), _) = cv2.getTextSize(
-                        boxes[i].name, cv2.FONT_HERSHEY_SIMPLEX, a/18.0, t)
-                    cv2.putText(image, boxes[i].name, (b[0]-int(a/2), b[3]+h),
-                                cv2.FONT_HERSHEY_SIMPLEX, a/18.0, C.WHITE, t)
-                    cv2.rectangle(image, b[0:2], b[2:4], active, t)
-                else:
-                    col = regular
-
-                # Draw the circle marker on each insect
-                cv2.line(image, (px, py-a), (px, py+a), col, t)
-                cv2.line(image, (px+a, py), (px-a, py), col, t)
-                cv2.circle(image, (px, py), a, col, t)
-
-    def findCorrectBox(self, live_pt, live_frame, static_frame, placed_boxes,
-                       big_draw):
+    def findCorrectBox(self, live_pt, live_frame, tray_size, static_frame,
+                       static_scale, placed_boxes, big_draw):
         """Finds the correct place to create a box once an insect has been
         removed from the draw, or selects an exsisting box.
 
@@ -413,18 +416,22 @@ class WitnessCam(QtCore.QObject):
         live_pt -- a point on the live frame representing the location of the
             insect
         live_frame -- grayscale difference map of the current camera frame
-        static_frame -- the static tray image scan as a numpy array
+        tray_size -- (width, height) of the full resolution tray scan
+        static_frame -- the displayed tray image scan as a numpy array
+        static_scale -- factor from full resolution tray coordinates to
+            static_frame ones
         placed_boxes -- Util.BugBoxList instance
         big_draw -- basic drawing length on the big label"""
 
         if live_pt is not None:
             # Generate a box on the camera image that contains the live point
-            (static_box, live_box) =\
-                self.floodFillBox(live_pt, live_frame, static_frame)
+            with PROFILER.span('floodfill'):
+                (static_box, live_box) =\
+                    self.floodFillBox(live_pt, live_frame, tray_size)
 
             if static_box is not None:
                 # Get the camera box position in the tray scan
-                (trayHeight, trayWidth, _) = static_frame.shape
+                (trayWidth, trayHeight) = tray_size
                 static_pt = poly2square(self.polygon_model, trayWidth,
                                         trayHeight, live_pt)
 
@@ -438,9 +445,12 @@ class WitnessCam(QtCore.QObject):
                     # Compare the new box to the stable one
                     (x1, y1, x2, y2) = self.stableBox[0]
                     (x3, y3, x4, y4) = static_box
-                    t = max(big_draw/5, 1)
-                    cv2.rectangle(static_frame, (x1, y1), (x2, y2), C.CYAN, t)
-                    cv2.rectangle(static_frame, (x3, y3), (x4, y4), C.WHITE, t)
+                    t = max(big_draw//5, 1)
+                    s = static_scale
+                    cv2.rectangle(static_frame, (int(x1*s), int(y1*s)),
+                                  (int(x2*s), int(y2*s)), C.CYAN, t)
+                    cv2.rectangle(static_frame, (int(x3*s), int(y3*s)),
+                                  (int(x4*s), int(y4*s)), C.WHITE, t)
                     w = x2-x1
                     h = y2-y1
                     eps = WitnessCam.BOX_ERROR_TOLERANCE
@@ -467,8 +477,7 @@ class WitnessCam(QtCore.QObject):
 
                     # If the new box significantly overlaps an exsisting box,
                     # use the exsisting box instead
-                    i = getOverlappingBox([b.static for b in placed_boxes],
-                                          self.stableBox[0])
+                    i = placed_boxes.getOverlappingBox(self.stableBox[0])
                     if i == -1:
                         box = BugBox("Box " + str(len(placed_boxes)),
                                      self.stableBox[1],
@@ -488,6 +497,26 @@ class WitnessCam(QtCore.QObject):
         """Called when the user has selected the four points that represent
         the corners of the insect tray in the camera view."""
 
+        self.setTrayArea(self.polyPoints)
+
+        self.sigScanningModeOn.emit(True)
+
+        self.phase = WitnessCam.CALIBRATION
+        self.showCalibrationWindow()
+        self.sigShowHint.emit(C.HINT_CALIBRATE)
+
+        # Save the current view of the camera
+        self.refreshCamera()
+
+    def setTrayArea(self, points):
+        """Set the corners of the insect tray in the camera view, and build
+        the mapping between the camera view and the tray scan.
+
+        Keyword Arguments:
+        points -- list of the four corners Pt(x,y) in camera coordinates"""
+
+        self.polyPoints = points
+
         # Get the axis aligned bounding box for the tray area selection
         (minx, miny, maxx, maxy) = \
             (self.polyPoints[0].x, self.polyPoints[0].y, 0, 0)
@@ -499,22 +528,14 @@ class WitnessCam(QtCore.QObject):
 
         self.trayBoundingBox = [Pt(minx, miny), Pt(maxx, maxy)]
         self.polygon_model = buildPolygonSquareModel(self.polyPoints)
-
-        self.sigScanningModeOn.emit(True)
-
-        self.phase = WitnessCam.CALIBRATION
-        self.showCalibrationWindow()
-        self.sigShowHint.emit(C.HINT_CALIBRATE)
-
-        # Save the current view of the camera
-        self.refreshCamera()
+        self.trayMask.invalidate()
 
     def showCalibrationWindow(self):
         """Show the calibration window"""
 
         self.calibrate = WitnessCam.CalibrationWindow(self)
 
-    def floodFillBox(self, p, camera_mask, static_frame):
+    def floodFillBox(self, p, camera_mask, tray_size):
         """Given a grayscale image and a point, return a bounding box
         encompassing all the non-zero elements of the image connected to the
         point. It returns the box dimensions on the camera frame, as well as
@@ -523,47 +544,67 @@ class WitnessCam(QtCore.QObject):
         Keyword Arguments:
         p -- the point on the camera image
         camera_mask -- the grayscale camera image difference
+        tray_size -- (width, height) of the full resolution tray scan
 
         Return: (live_box, static_box)
         live_box -- the dimensions of the box (x1,y1,x2,y2) on the live frame
         static_ box -- the dimensions of the box (x1,y1,x2,y2) on the static
             frame"""
 
-        # Convert grayscale image to binary mask
-        frame = np.copy(camera_mask)
-        frame[frame > WitnessCam.GRAY_THRESHOLD] = 1
-
-        # Find countours in image
-        staticContour = []
-        conts, hir = cv2.findContours(frame, cv2.RETR_LIST,
-                                      cv2.CHAIN_APPROX_NONE)
-
-        # Find contour that encases the point
-        for i in range(len(conts)):
-            if cv2.pointPolygonTest(conts[i], p.t(), True) >= 0:
-                (trayHeight, trayWidth, _) = static_frame.shape
-                (sx1, sy1, sx2, sy2) = (trayWidth, trayHeight, 0, 0)
-                (lx1, ly1, lx2, ly2) = (trayWidth, trayHeight, 0, 0)
-
-                # Generate the box that encases the contour in both the live
-                # and static image
-                for q in conts[i]:
-                    (lx, ly) = q[0]
-                    (sx, sy) = poly2square(
-                        self.polygon_model, trayWidth, trayHeight,
-                        Pt(q[0, 0], q[0, 1])).t()
-                    sx1 = min(sx1, sx)
-                    sy1 = min(sy1, sy)
-                    sx2 = max(sx2, sx)
-                    sy2 = max(sy2, sy)
-                    lx1 = min(lx1, lx)
-                    ly1 = min(ly1, ly)
-                    lx2 = max(lx2, lx)
-                    ly2 = max(ly2, ly)
-                    staticContour.append((sx, sy))
-                return ((sx1, sy1, sx2, sy2), (lx1, ly1, lx2, ly2))
-
-        return (None, None)
+        # Only the tray area can contain a difference, so just work on it
+        (x1, y1, x2, y2) = self.differenceEngine.cropRegion(
+            camera_mask.shape, self.trayBoundingBox)
+        (sx, sy) = (p.x-x1, p.y-y1)
+        frame = np.ascontiguousarray(camera_mask[y1:y2, x1:x2])
+        (h, w) = frame.shape
+        if sx < 0 or sy < 0 or sx >= w or sy >= h:
+            return (None, None)
+
+        if frame[sy, sx] > 0:
+            # Label the component connected to the point. The fill mask is
+            # padded by one pixel, so it also serves as the zero border that
+            # findContours expects around the component
+            fillMask = np.zeros((h+2, w+2), np.uint8)
+            rect = cv2.floodFill(
+                frame, fillMask, (sx, sy), 0, int(frame[sy, sx])-1, 255,
+                8 | cv2.FLOODFILL_MASK_ONLY | cv2.FLOODFILL_FIXED_RANGE |
+                (1 << 8))[-1]
+            (rx, ry, rw, rh) = rect
+            liveBox = (x1+rx, y1+ry, x1+rx+rw-1, y1+ry+rh-1)
+
+            component = np.copy(fillMask[ry:ry+rh+2, rx:rx+rw+2])
+            conts, hir = cv2.findContours(component, cv2.RETR_EXTERNAL,
+                                          cv2.CHAIN_APPROX_SIMPLE)
+            contour = max(conts, key=len)
+            offset = (x1+rx-1, y1+ry-1)
+        else:
+            # The point is not on the difference (eg. it is in a hole), so
+            # find the contour that encases it instead
+            conts, hir = cv2.findContours(frame, cv2.RETR_LIST,
+                                          cv2.CHAIN_APPROX_NONE)
+            contour = None
+            for c in conts:
+                if cv2.pointPolygonTest(c, (sx, sy), False) >= 0:
+                    contour = c
+                    break
+            if contour is None:
+                return (None, None)
+
+            offset = (x1, y1)
+            (lx1, ly1) = contour.reshape(-1, 2).min(axis=0) + offset
+            (lx2, ly2) = contour.reshape(-1, 2).max(axis=0) + offset
+            liveBox = (int(lx1), int(ly1), int(lx2), int(ly2))
+
+        # The perspective mapping keeps straight lines straight, so the
+        # extremes of the mapped component are at its convex hull points
+        hull = cv2.convexHull(contour).reshape(-1, 2) + offset
+        (trayWidth, trayHeight) = tray_size
+        staticPts = poly2squareArray(
+            self.polygon_model, trayWidth, trayHeight, hull)
+        (sx1, sy1) = staticPts.min(axis=0)
+        (sx2, sy2) = staticPts.max(axis=0)
+
+        return ((int(sx1), int(sy1), int(sx2), int(sy2)), liveBox)
 
     def resetTrayArea(self):
         """Called when the suer whants to reset the tray area trace"""
@@ -574,6 +615,7 @@ class WitnessCam(QtCore.QObject):
 
         self.trayBoundingBox = None
         self.polygonModel = None
+        self.trayMask.invalidate()
         self.sigScanningModeOn.emit(False)
 
         self.setCurrentSelectionBox(None, -1)
@@ -607,6 +649,7 @@ class WitnessCam(QtCore.QObject):
             self.camBackground = np.copy(self.cameraImage)
             self.camBackground = cv2.cvtColor(self.camBackground,
                                               cv2.cv.CV_BGR2Lab)
+            self.backgroundVersion += 1
             self.stableRun = 0
             self.stableRunBox = 0
 
@@ -622,10 +665,19 @@ class WitnessCam(QtCore.QObject):
             self.sigShowHint.emit(C.HINT_ENTERBARCODE)
         else:
             self.currentSelectionBox = None
+        self.trayMask.invalidate()
 
         self.removedBug = i
         self.sigRemovedBug.emit(i)
 
+    def shutdown(self):
+        """Stop the frame difference worker process, if there is one"""
+
+        if self.differenceWorker is not None:
+            self.differenceWorker.stop()
+            self.differenceWorker = None
+        self.useWorker = False
+
     @QtCore.Slot()
     def onEditBoxSelected(self, i):
         self.refreshCamera()
@@ -718,6 +770,12 @@ class WitnessCam(QtCore.QObject):
             mainContent.addLayout(self.lblDiffVal, 6, 0, 1, 2)
             mainContent.addLayout(self.lblDeltaVal, 7, 0, 1, 2)
 
+            # Stage timings, only shown when the profiler is on
+            self.lblTimings = QtGui.QLabel()
+            self.lblTimings.setFont(QtGui.QFont('Monospace'))
+            self.lblTimings.setVisible(PROFILER.enabled)
+            self.timingsUpdated = 0
+            mainContent.addWidget(self.lblTimings, 8, 0, 1, 2)
 
             self.setLayout(mainContent)
 
@@ -800,6 +858,11 @@ class WitnessCam(QtCore.QObject):
             self.lblDiffVal.updateValue(diff)
             self.lblDeltaVal.updateValue(delta)
 
+            if PROFILER.enabled and \
+                    time() - self.timingsUpdated > WitnessCam.TIMINGS_INTERVAL:
+                self.timingsUpdated = time()
+                self.lblTimings.setText(PROFILER.format())
+
         def textChanged(self, config, val):
             self.data.refreshCamera()
             if config == 0:
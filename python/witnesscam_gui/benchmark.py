@@ -0,0 +1,280 @@
+# Benchmarks of the vision hot paths
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+from timeit import default_timer
+import platform
+import json
+import sys
+import numpy as np
+import cv2
+
+from Pt import Pt
+from Util import *
+from TrayImage import TrayImageCache, TrayRenderer
+from GUIParts import BigLabel, SmallLabel
+from WitnessCam import WitnessCam
+
+CAMERA_SIZES = [(320, 180), (640, 360), (640, 480), (1280, 720)]
+BOX_COUNTS = [10, 100, 500]
+TRAY_SIZE = (4000, 3000)
+RUNS = 50
+
+# Corners of the tray in the camera frame, as fractions of the frame size
+TRAY_CORNERS = [(0.15, 0.10), (0.85, 0.12), (0.88, 0.90), (0.12, 0.88)]
+
+
+class SyntheticScene:
+    """A generated tray scan with insects laid out on a grid, and the camera
+    view of it, with and without one of the insects."""
+
+    BACKGROUND = (60, 70, 80)
+    TRAY = (215, 210, 200)
+    INSECT = (30, 45, 70)
+
+    def __init__(self, camera_size, tray_size, count, seed=0):
+        """Constructor
+
+        Keyword Arguments:
+        camera_size -- (width, height) of the camera frames
+        tray_size -- (width, height) of the tray scan
+        count -- number of insects on the tray
+        seed -- seed of the random jitter of the insects"""
+
+        rng = np.random.RandomState(seed)
+        (tw, th) = tray_size
+        (cw, ch) = camera_size
+
+        # Lay the insects out on a grid with the same aspect as the tray
+        cols = int(np.ceil(np.sqrt(count*float(tw)/th)))
+        rows = int(np.ceil(float(count)/cols))
+        (gw, gh) = (tw//cols, th//rows)
+        (rx, ry) = (gw//4, gh//4)
+
+        self.tray = np.empty((th, tw, 3), np.uint8)
+        self.tray[...] = SyntheticScene.TRAY
+        self.boxes = BugBoxList()
+        for i in range(count):
+            (x, y) = ((i % cols)*gw + gw//2, (i//cols)*gh + gh//2)
+            (x, y) = (x + rng.randint(-rx//4, rx//4+1),
+                      y + rng.randint(-ry//4, ry//4+1))
+            cv2.ellipse(self.tray, (x, y), (rx//2, ry), 0, 0, 360,
+                        SyntheticScene.INSECT, -1)
+            self.boxes.newBox(BugBox('Box %d' % i, None,
+                                     (x-rx, y-ry, x+rx, y+ry), (x, y)))
+
+        # The insect in the middle is the one that gets removed
+        self.removed = count//2
+        (x1, y1, x2, y2) = self.boxes[self.removed].static
+        empty = np.copy(self.tray)
+        empty[y1:y2+1, x1:x2+1] = SyntheticScene.TRAY
+
+        self.corners = [Pt(int(u*cw), int(v*ch)) for (u, v) in TRAY_CORNERS]
+        self.frame = self.view(self.tray, camera_size)
+        self.removedFrame = self.view(empty, camera_size)
+
+    def view(self, tray, camera_size):
+        """Return: the camera view of a tray image"""
+
+        (th, tw) = tray.shape[0:2]
+        src = np.float32([[0, 0], [tw, 0], [tw, th], [0, th]])
+        dst = np.float32([p.t() for p in self.corners])
+        frame = np.empty((camera_size[1], camera_size[0], 3), np.uint8)
+        frame[...] = SyntheticScene.BACKGROUND
+        cv2.warpPerspective(tray, cv2.getPerspectiveTransform(src, dst),
+                            camera_size, frame, cv2.INTER_AREA,
+                            cv2.BORDER_TRANSPARENT)
+        return frame
+
+
+class NullLogger:
+    """Logger that throws the log messages away"""
+
+    def log(self, string, level=0):
+        pass
+
+
+def timeStage(fn, runs, setup=None):
+    """Time a function.
+
+    Keyword Arguments:
+    fn -- the function to time, called without arguments
+    runs -- number of times to call it
+    setup -- function called before each call, that is not timed
+
+    Return: dictionary with the number of runs and the minimum, median and
+        mean time of a call in milliseconds"""
+
+    times = np.empty(runs)
+    for i in range(runs):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        fn()
+        times[i] = default_timer() - start
+
+    times *= 1000
+    return {'runs': runs, 'min_ms': float(times.min()),
+            'median_ms': float(np.median(times)),
+            'mean_ms': float(times.mean())}
+
+
+def benchmarkCase(camera_size, count, runs, labels=None):
+    """Time each stage on one generated scene.
+
+    Keyword Arguments:
+    camera_size -- (width, height) of the camera frames
+    count -- number of insects on the tray
+    runs -- number of times to run each stage
+    labels -- (big, small) GUIParts labels to time setImage(..) with, or None
+
+    Return: dictionary with the times of each stage"""
+
+    scene = SyntheticScene(camera_size, TRAY_SIZE, count)
+    tray = TrayRenderer(TrayImageCache(scene.tray))
+    boxes = scene.boxes
+    bigSize = BigLabel.originalSize
+    smallSize = SmallLabel.originalSize
+    (tw, th) = TRAY_SIZE
+
+    # Put the vision system in scanning mode, with the full tray as the
+    # background and the insect in the middle removed
+    wc = WitnessCam(NullLogger(), None)
+    wc.cameraImage = scene.frame
+    wc.setTrayArea(scene.corners)
+    wc.phase = WitnessCam.SCANNING_MODE
+    wc.refreshCamera()
+    wc.amendFrame(scene.removedFrame, tray, bigSize, smallSize, boxes)
+
+    # Keep the view stable, but never long enough to accept the box, so every
+    # tick goes all the way to finding the box of the removed insect. A single
+    # insect is a small part of a large tray, so any difference is accepted.
+    # The threshold is shared by every WitnessCam, so it is put back after
+    threshold = WitnessCam.STABLE_FRAME_ACTION_THRESHOLD
+    WitnessCam.STABLE_FRAME_ACTION_THRESHOLD = 0
+
+    def stable():
+        wc.stableRun = WitnessCam.ACTION_DELAY + 1
+        wc.stableBoxRun = 0
+        wc.stableBox = None
+
+    try:
+        stable()
+        frame = np.copy(scene.removedFrame)
+        (diff, centroid) = wc.getFrameDifferenceCentroid(frame)
+        diff = np.copy(diff)
+        static = boxes.getStaticBoxes()
+        corners = static[:, [0, 1, 0, 3, 2, 3, 2, 1]].reshape(-1, 2)
+        liveCorners = square2polyArray(wc.polygon_model, tw, th, corners)
+        box = tuple(boxes[scene.removed].static)
+
+        stages = dict()
+        stages['getFrameDifferenceCentroid'] = timeStage(
+            lambda: wc.getFrameDifferenceCentroid(frame), runs, stable)
+        stages['findWeightedMedianPoint2D'] = timeStage(
+            lambda: findWeightedMedianPoint2D(diff, wc.trayBoundingBox), runs)
+        stages['floodFillBox'] = timeStage(
+            lambda: wc.floodFillBox(centroid, diff, TRAY_SIZE), runs)
+        stages['poly2square'] = timeStage(
+            lambda: poly2square(wc.polygon_model, tw, th, centroid), runs)
+        stages['square2poly'] = timeStage(
+            lambda: square2poly(wc.polygon_model, tw, th, Pt(tw//2, th//2)),
+            runs)
+        stages['poly2squareArray'] = timeStage(
+            lambda: poly2squareArray(wc.polygon_model, tw, th, liveCorners),
+            runs)
+        stages['square2polyArray'] = timeStage(
+            lambda: square2polyArray(wc.polygon_model, tw, th, corners), runs)
+        stages['getOverlappingBox'] = timeStage(
+            lambda: getOverlappingBox(static, box), runs)
+        stages['BugBoxList.getOverlappingBox'] = timeStage(
+            lambda: boxes.getOverlappingBox(box), runs)
+        stages['amendFrame'] = timeStage(
+            lambda: wc.amendFrame(frame, tray, bigSize, smallSize, boxes),
+            runs, stable)
+
+        if labels is not None:
+            (big, small) = wc.amendFrame(frame, tray, bigSize, smallSize,
+                                         boxes)[0:2]
+            (lblBig, lblSmall) = labels
+            stages['setImage'] = timeStage(
+                lambda: (lblBig.setImage(*big), lblSmall.setImage(*small)),
+                runs)
+    finally:
+        WitnessCam.STABLE_FRAME_ACTION_THRESHOLD = threshold
+        wc.shutdown()
+
+    return {'camera': list(camera_size), 'tray': list(TRAY_SIZE),
+            'boxes': count, 'stages': stages}
+
+
+def main():
+    """Benchmark the vision hot paths on generated data:
+
+        $ python2.7 benchmark.py [-o results.json] [-r runs] [-n]
+
+    -n skips the label benchmarks, which need a display"""
+
+    resultsfile = None
+    runs = RUNS
+    useLabels = True
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-o':
+            resultsfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-r':
+            runs = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-n':
+            useLabels = False
+            i += 1
+        else:
+            sys.exit(main.__doc__)
+
+    labels = None
+    if useLabels:
+        from PySide import QtGui
+        app = QtGui.QApplication(sys.argv)
+        logger = NullLogger()
+        labels = (BigLabel(None, logger), SmallLabel(None))
+
+    cases = []
+    for size in CAMERA_SIZES:
+        for count in BOX_COUNTS:
+            sys.stderr.write('camera %dx%d, %d boxes\n'
+                             % (size[0], size[1], count))
+            cases.append(benchmarkCase(size, count, runs, labels))
+
+    results = {'python': platform.python_version(),
+               'numpy': np.__version__,
+               'opencv': cv2.__version__,
+               'machine': platform.machine(),
+               'processor': platform.processor(),
+               'cases': cases}
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if resultsfile is not None:
+        with open(resultsfile, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
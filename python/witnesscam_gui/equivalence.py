@@ -0,0 +1,586 @@
+# Checks that the rewritten vision code gives the same results as the code it
+# replaced, on random inputs
+#
+# Technology for Nature. British Natural History Museum insect specimen
+# digitization project.
+#
+# Copyright (C) 2014    Syed Zahir Bokhari, Prof. Michael Terry
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software Foundation,
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+import math
+import sys
+import numpy as np
+
+from Pt import Pt
+from Util import *
+import Util
+
+TRIALS = 500
+
+
+def referenceWeightedMedian1D(lst):
+    """weightedMedian1D(..) as it was before it was vectorized.
+
+    Keyword Arguments:
+    lst -- the list of values (i, mag) where 'i' is the cooridinate and 'mag'
+        is the weight at that coordinate
+
+    Return: pos
+    pos -- the coordinate in the list where the median is located"""
+
+    lst.sort()
+
+    # Convert distribution of weights into cumulative distribution
+    for i in range(1, len(lst)):
+        (cord, weight) = lst[i]
+        (_, prev_weight) = lst[i-1]
+        lst[i] = (cord, weight+prev_weight)
+
+    # Binary search for the mid value in the cumulative distribution
+    if lst:
+        xmed = lst[-1][1]/2
+        low = 0
+        high = len(lst)-1
+        while (high-low > 1):
+            check = int(math.floor((high+low)/2))
+            (v, w) = lst[check]
+            if w > xmed:
+                high = check
+            elif w < xmed:
+                low = check
+            else:
+                low = check
+                high = check
+                break
+        return lst[high][0]
+
+
+def expectedWeightedMedian1D(lst):
+    """The result the new weightedMedian1D(..) should give for a list of
+    (coordinate, weight) values with positive weights.
+
+    This is referenceWeightedMedian1D(..), except for one case. The old binary
+    search never looked at the first value, so it gave the second one even
+    when the first value held half of the weight or more. The new version
+    gives the first value then."""
+
+    lst = sorted(lst)
+    total = sum([w for (_, w) in lst])
+    if len(lst) > 1 and 2*lst[0][1] >= total:
+        return lst[0][0]
+    return referenceWeightedMedian1D(lst)
+
+
+def referenceMedianLists(image, roi, step):
+    """The (x, weight) and (y, weight) lists that findWeightedMedianPoint2D(..)
+    built before it was vectorized. The weights are taken as floats, since the
+    old code added up the uint8 pixels as uint8, which wrapped around.
+
+    Keyword Arguments:
+    image -- the 2D grayscale image
+    roi -- the region of interest [Pt(x1,y1), Pt(x2,y2)]
+    step -- the stride of the sampled pixels. The old code used
+        int(sqrt(area)/50), the new one reads every pixel, so 1 gives the
+        same samples as the new code
+
+    Return: (xlist, ylist)"""
+
+    xlist = []
+    ylist = []
+    for x in range(roi[0].x, roi[1].x, step):
+        for y in range(roi[0].y, roi[1].y, step):
+            if image[y, x] > 0:
+                xlist.append((x, float(image[y, x])))
+                ylist.append((y, float(image[y, x])))
+    return (xlist, ylist)
+
+
+def checkWeightedMedian1D(weights):
+    """Check weightedMedian1D(..) against the old version on one distribution.
+
+    Keyword Arguments:
+    weights -- 1D array of non-negative weights"""
+
+    lst = [(i, float(w)) for (i, w) in enumerate(weights) if w > 0]
+    new = weightedMedian1D(np.asarray(weights, dtype=np.float64))
+    if len(lst) == 0:
+        assert new is None, 'weights %s: %s' % (list(weights), new)
+        return
+
+    old = expectedWeightedMedian1D(lst)
+    assert new == old, 'weights %s: %s != %s' % (list(weights), new, old)
+    assert weights[new] > 0, 'weights %s: median %s has no weight' \
+        % (list(weights), new)
+
+
+def checkWeightedMedian(rng, trials):
+    """Check weightedMedian1D(..) and findWeightedMedianPoint2D(..) against
+    the old versions, on distributions with ties and zero weights.
+
+    Keyword Arguments:
+    rng -- numpy RandomState
+    trials -- number of random distributions and images to check"""
+
+    # Halves that fall exactly on a value or between two values, and zero
+    # weights before, after and between the values
+    cases = [[], [0], [0, 0, 0], [3], [0, 3, 0], [1, 1], [1, 1, 1, 1],
+             [2, 1, 1], [1, 1, 2], [1, 0, 0, 1], [0, 2, 0, 2, 0],
+             [5, 0, 0, 0, 1], [1, 2, 3, 0, 6], [0, 0, 1, 1, 1, 1, 0, 0]]
+    for weights in cases:
+        checkWeightedMedian1D(weights)
+
+    # Few distinct weights and many zeros make ties likely
+    for i in range(trials):
+        n = rng.randint(1, 40)
+        weights = rng.randint(0, 4, n) * (rng.rand(n) < rng.rand())
+        checkWeightedMedian1D(weights)
+
+    for i in range(trials):
+        (h, w) = (rng.randint(20, 120), rng.randint(20, 160))
+        density = rng.choice([0.0, 0.002, 0.05, 0.5, 1.0])
+        image = (rng.randint(0, 256, (h, w)) *
+                 (rng.rand(h, w) < density)).astype(np.uint8)
+        (x1, x2) = sorted(rng.randint(0, w+1, 2))
+        (y1, y2) = sorted(rng.randint(0, h+1, 2))
+        roi = [Pt(x1, y1), Pt(x2, y2)]
+
+        new = findWeightedMedianPoint2D(image, roi)
+        (xlist, ylist) = referenceMedianLists(image, roi, 1)
+        if len(xlist) == 0:
+            assert new is None, 'roi %s: %s' % (roi, new)
+            continue
+        old = Pt(expectedWeightedMedian1D(xlist),
+                 expectedWeightedMedian1D(ylist))
+        assert new == old, 'roi %s: %s != %s' % (roi, new, old)
+
+
+def referencePoly2Unit(model, pos):
+    """poly2square(..) as it was before the model held a homography, on the
+    unit square and without truncating to ints.
+
+    Keyword Arguments:
+    model -- a polygon-square model produced by buildPolygonSquareModel(..)
+    pos -- the point (x,y) inside the polygon
+
+    Return: (u, v) floats"""
+
+    (p0, A, B, C, D, E, F, G, H) = model
+    (x, y) = (pos[0]-p0.x, pos[1]-p0.y)
+
+    v = (-A*F+A*y+C*D-C*G*y-D*x+F*G*x)/(A*E-A*H*y-B*D+B*G*y+D*H*x-E*G*x)
+    u = (-C-B*v+x+H*v*x)/(A-G*x)
+
+    return (u, v)
+
+
+def referenceUnit2Poly(model, u, v):
+    """square2poly(..) from the 9 coefficients of the model, on the unit
+    square and without truncating to ints.
+
+    Return: (x, y) floats"""
+
+    (p0, A, B, C, D, E, F, G, H) = model
+
+    x = (A*u+B*v+C)/(G*u+H*v+1) + p0.x
+    y = (D*u+E*v+F)/(G*u+H*v+1) + p0.y
+
+    return (x, y)
+
+
+def applyHomography(matrix, pts):
+    """Return: the Nx2 points mapped through a 3x3 homography, as floats"""
+
+    pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+    (x, y, w) = matrix.dot(np.column_stack((pts, np.ones(len(pts)))).T)
+    return np.column_stack((x/w, y/w))
+
+
+def checkTruncated(new, exact, what):
+    """Check that ints are the truncation of the exact float values. A value
+    that lies on an integer, such as a corner of the polygon, may round
+    either way, so it may be off by one.
+
+    Keyword Arguments:
+    new -- the ints computed by the new code
+    exact -- the same values as floats, from the old code
+    what -- description of the values for the error message"""
+
+    new = np.asarray(new).reshape(-1)
+    exact = np.asarray(exact, dtype=np.float64).reshape(-1)
+    onInteger = np.abs(exact - np.round(exact)) < 1e-6*np.maximum(
+        1, np.abs(exact))
+    allowed = np.where(onInteger, 1, 0)
+    bad = np.flatnonzero(np.abs(new - exact.astype(int)) > allowed)
+    assert len(bad) == 0, '%s: %s != %s' \
+        % (what, new[bad].tolist(), exact[bad].tolist())
+
+
+def checkPolygonModel(rng, trials):
+    """Check the homographies of PolygonSquareModel and the functions built on
+    them against the 9-coefficient model, on random trays and points.
+
+    Keyword Arguments:
+    rng -- numpy RandomState
+    trials -- number of random trays to check"""
+
+    for i in range(trials):
+        # A tray seen at an angle, with the corners in clockwise order from
+        # the top-left, in a camera frame of size (cw, ch)
+        (cw, ch) = [(320, 180), (640, 480), (1280, 720)][rng.randint(3)]
+        (sw, sh) = (rng.randint(100, 5000), rng.randint(100, 5000))
+        base = np.array([[0.15, 0.1], [0.85, 0.1], [0.85, 0.9], [0.15, 0.9]])
+        corners = (base + rng.uniform(-0.1, 0.1, (4, 2))) * (cw, ch)
+        corners = [Pt(int(x), int(y)) for (x, y) in corners]
+        model = buildPolygonSquareModel(corners)
+        what = 'corners %s, square %dx%d' % (corners, sw, sh)
+
+        # Square to polygon, and back through the inverse homography
+        unit = rng.uniform(-0.05, 1.05, (50, 2))
+        exact = np.array([referenceUnit2Poly(model, u, v) for (u, v) in unit])
+        assert np.allclose(applyHomography(model.homography, unit), exact,
+                           rtol=0, atol=1e-6), what
+        assert np.allclose(applyHomography(model.inverse, exact), unit,
+                           rtol=0, atol=1e-9), what
+        assert np.allclose(
+            applyHomography(model.toPolygon(sw, sh), unit*(sw, sh)), exact,
+            rtol=0, atol=1e-6), what
+        assert np.allclose(model.toSquare(sw, sh).dot(model.toPolygon(sw, sh)),
+                           np.eye(3), rtol=0, atol=1e-9), what
+        points = [Pt(int(u*sw), int(v*sh)) for (u, v) in unit]
+        square = np.array([p.t() for p in points])
+        assert [list(square2poly(model, sw, sh, p).t()) for p in points] == \
+            square2polyArray(model, sw, sh, square).tolist(), what
+
+        # Polygon to square, at the corners and at random points around the
+        # polygon
+        pts = np.vstack(([p.t() for p in corners],
+                         rng.randint(0, (cw, ch), (50, 2))))
+        exact = np.array([referencePoly2Unit(model, p) for p in pts])
+        assert np.allclose(applyHomography(model.inverse, pts), exact,
+                           rtol=0, atol=1e-9), what
+        exact *= (sw, sh)
+        new = [poly2square(model, sw, sh, Pt(x, y)).t() for (x, y) in pts]
+        checkTruncated(new, exact, what)
+        checkTruncated(poly2squareArray(model, sw, sh, pts), exact, what)
+
+
+class ReferenceBugBox:
+    """BugBox as it was before its data moved to the columns of a
+    BugBoxStore"""
+
+    def __init__(self, name, livebox, staticbox, pt):
+        self.name = name
+        self.live = livebox
+        self.static = staticbox
+        self.point = pt
+
+
+class ReferenceBugBoxList:
+    """BugBoxList as it was before it kept its boxes in a BugBoxStore and a
+    BugBoxGrid: a plain list of boxes with the same undo and redo actions"""
+
+    Action = BugBoxList.Action
+
+    def __init__(self):
+        self.boxes = []
+        self.undoStack = []
+        self.redoStack = []
+
+    def newBox(self, box):
+        self.recordAction(BugBoxList.Action.newBox(len(self.boxes)),
+                          self.undoStack)
+        self.boxes.append(box)
+        if box.live is None:
+            self.recomputeLiveBoxes = True
+
+    def shouldRecomputeLiveBoxes(self, i=None):
+        if i is None:
+            return self.recomputeLiveBoxes
+        elif i < len(self.boxes):
+            return self.boxes[i].live is None
+
+    def __getitem__(self, index):
+        return self.boxes[index]
+
+    def __iter__(self):
+        return iter(self.boxes)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def delete(self, index):
+        box = self.boxes[index]
+        self.recordAction(BugBoxList.Action.deleteBox(index, box),
+                          self.undoStack)
+        del self.boxes[index]
+
+    def changeBox(self, index, name=None, live=None, static=None, point=None):
+        self.recordAction(BugBoxList.Action.changeBox(
+            index,
+            name=self.boxes[index].name if name is not None else None,
+            static=self.boxes[index].static if static is not None else None,
+            live=self.boxes[index].live if live is not None else None,
+            point=self.boxes[index].point if point is not None else None),
+            self.undoStack)
+
+        if name is not None:
+            self.boxes[index].name = name
+        if live is not None:
+            self.boxes[index].live = live
+        if static is not None:
+            self.boxes[index].static = static
+        if point is not None:
+            self.boxes[index].point = point
+
+    def recordAction(self, action, stack, clear_redo=True, allow_merge=True):
+        if len(stack) == 0 or not allow_merge or not stack[-1].merge(action):
+            stack.append(action)
+            if clear_redo:
+                self.redoStack = []
+
+    def undoRedo(self, undo=True):
+        stack1 = self.undoStack
+        stack2 = self.redoStack
+        if not undo:
+            stack1 = self.redoStack
+            stack2 = self.undoStack
+
+        act = None
+        if len(stack1) > 0:
+            act = stack1[-1]
+            del stack1[-1]
+        else:
+            return None
+
+        if act.action == BugBoxList.Action.CREATE_BOX:
+            self.recordAction(BugBoxList.Action.deleteBox(
+                act.index, self.boxes[act.index]), stack2, False, False)
+            del self.boxes[act.index]
+            return -1
+        elif act.action == BugBoxList.Action.DELETE_BOX:
+            self.recordAction(BugBoxList.Action.newBox(act.index),
+                              stack2, False, False)
+            self.boxes.insert(act.index, act.box)
+            return act.index
+        elif act.action == BugBoxList.Action.TRANSFORM_BOX_FROM:
+            i = act.index
+            box = self.boxes[i]
+            self.recordAction(BugBoxList.Action.changeBox(
+                i,
+                name=box.name if act.name is not None else None,
+                static=box.static if act.static is not None else None,
+                live=box.live if act.live is not None else None,
+                point=box.point if act.point is not None else None),
+                stack2, False, False)
+            box.name = act.name if act.name is not None else box.name
+            box.static = act.static if act.static is not None else box.static
+            box.live = act.live if act.live is not None else box.live
+            box.point = act.point if act.point is not None else box.point
+            return act.index if act.index is not None else -1
+
+
+class StepClock:
+    """Stands in for time.time() while the box lists are checked. Changes
+    made less than a second apart are merged into one undo action, so a
+    clock that moves a fixed step per action makes the merges the same on
+    every run, however fast the checks go."""
+
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def randomBoxData(rng, size):
+    """Return: random (name, live, static, point) of a box on a tray of size
+    (width, height). The live box is None for some boxes, and the corners of
+    the static box are swapped for some, as for a box drawn up and left"""
+
+    (w, h) = size
+    (x, y) = (int(rng.randint(w)), int(rng.randint(h)))
+    (bw, bh) = (int(rng.randint(1, 300)), int(rng.randint(1, 300)))
+    static = (x, y, x+bw, y+bh)
+    if rng.rand() < 0.1:
+        static = (x+bw, y+bh, x, y)
+    live = None
+    if rng.rand() < 0.7:
+        live = tuple(int(v) for v in rng.randint(0, 640, 4))
+    point = (x + bw//2, y + bh//2)
+    return ('Box %d' % rng.randint(1000000), live, static, point)
+
+
+def checkBugBoxLists(rng, ref, new, peak, size):
+    """Check that a BugBoxList holds the same boxes as a ReferenceBugBoxList,
+    in the same order, and that its store, grid and positions agree with
+    them.
+
+    Keyword Arguments:
+    rng -- numpy RandomState for the query rectangles
+    ref -- the ReferenceBugBoxList
+    new -- the BugBoxList
+    peak -- the most boxes the lists have held at once
+    size -- (width, height) of the tray"""
+
+    assert len(new) == len(ref), '%d != %d' % (len(new), len(ref))
+    data = [(b.name, b.live, b.static, b.point) for b in ref]
+    assert [(b.name, b.live, b.static, b.point) for b in new] == data
+    # Neither list sets the flag before the first box without a live box
+    assert getattr(new, 'recomputeLiveBoxes', None) == \
+        getattr(ref, 'recomputeLiveBoxes', None)
+    for i in range(len(ref)):
+        assert new.shouldRecomputeLiveBoxes(i) == \
+            ref.shouldRecomputeLiveBoxes(i)
+        assert new.indexOf(new[i]) == i
+
+    # The columns, in list order
+    static = np.array([s for (_, _, s, _) in data], np.int32).reshape(-1, 4)
+    assert new.getNames().tolist() == [n for (n, _, _, _) in data]
+    assert np.array_equal(new.getStaticBoxes(), static)
+    assert new.getPoints().tolist() == [list(p) for (_, _, _, p) in data]
+    (live, hasLive) = new.getLiveBoxes()
+    assert hasLive.tolist() == [l is not None for (_, l, _, _) in data]
+    assert live[hasLive].tolist() == \
+        [list(l) for (_, l, _, _) in data if l is not None]
+
+    # Every box in the list has its own row, the rows of the removed boxes
+    # are free, and the rows are reused so the store never holds more rows
+    # than the most boxes the list has held
+    store = new.store
+    rows = new.getRows().tolist()
+    assert len(set(rows)) == len(rows)
+    assert sorted(rows + store.free) == list(range(store.count))
+    assert store.count <= peak, '%d rows for %d boxes' % (store.count, peak)
+    for act in new.undoStack + new.redoStack:
+        if act.box is not None:
+            assert act.box.store is None and act.box.row is None
+
+    # The grid holds each box in the cells of its static box, and nothing
+    # else
+    cells = dict()
+    for b in new:
+        for cell in new.grid.cellsFor(b.static):
+            cells.setdefault(cell, set()).add(id(b))
+    assert dict((cell, set(boxes.keys())) for (cell, boxes)
+                in new.grid.cells.items()) == cells
+
+    # Queries through the grid find what a scan of the whole list finds
+    (w, h) = size
+    for i in range(5):
+        (x, y) = (rng.randint(-100, w), rng.randint(-100, h))
+        rect = (x, y, x + rng.randint(0, 800), y + rng.randint(0, 800))
+        (x1, y1, x2, y2) = rect
+        found = [j for (j, (u1, v1, u2, v2)) in enumerate(static.tolist())
+                 if not (x1 > max(u1, u2) or min(u1, u2) > x2 or
+                         y1 > max(v1, v2) or min(v1, v2) > y2)]
+        assert new.query(rect) == found, 'query %s' % (rect,)
+        assert new.getOverlappingBox(rect) == getOverlappingBox(static, rect)
+
+
+def checkBugBoxList(rng, trials):
+    """Check BugBoxList against the plain list it replaced, on random
+    sequences of new boxes, deletes, changes, undos and redos.
+
+    Keyword Arguments:
+    rng -- numpy RandomState
+    trials -- number of random sequences to check"""
+
+    size = (4000, 3000)
+    actions = ['new', 'delete', 'change', 'undo', 'redo']
+    clock = Util.time
+    try:
+        for i in range(trials):
+            # Both lists read the same clock in turn, so the time between two
+            # actions on a list is always 2*step
+            Util.time = StepClock(rng.choice([0.2, 0.4, 1.0]))
+            ref = ReferenceBugBoxList()
+            new = BugBoxList()
+            peak = 0
+            done = []
+            weights = rng.dirichlet(np.ones(len(actions)))
+            for j in range(rng.randint(1, 60)):
+                action = actions[rng.choice(len(actions), p=weights)]
+                if action == 'new' or (action in ['delete', 'change'] and
+                                       len(ref) == 0):
+                    (name, live, static, point) = randomBoxData(rng, size)
+                    ref.newBox(ReferenceBugBox(name, live, static, point))
+                    new.newBox(BugBox(name, live, static, point))
+                    action = 'new'
+                elif action == 'delete':
+                    k = rng.randint(len(ref))
+                    ref.delete(k)
+                    new.delete(k)
+                elif action == 'change':
+                    k = rng.randint(len(ref))
+                    (name, live, static, point) = randomBoxData(rng, size)
+                    fields = dict(name=name, live=live, static=static,
+                                  point=point)
+                    for key in list(fields.keys()):
+                        if fields[key] is None or rng.rand() < 0.5:
+                            del fields[key]
+                    ref.changeBox(k, **fields)
+                    new.changeBox(k, **fields)
+                elif action == 'undo':
+                    index = ref.undoRedo(True)
+                    assert new.undo() == index
+                else:
+                    index = ref.undoRedo(False)
+                    assert new.redo() == index
+
+                done.append(action)
+                peak = max(peak, len(ref))
+                try:
+                    checkBugBoxLists(rng, ref, new, peak, size)
+                except AssertionError as e:
+                    raise AssertionError('after %s: %s' % (done, e))
+    finally:
+        Util.time = clock
+
+
+def main():
+    """Check the rewritten vision code against the code it replaced:
+
+        $ python2.7 equivalence.py [-r trials] [-s seed]
+
+    Each check runs on 'trials' random inputs. An AssertionError names the
+    first input where the two differ"""
+
+    trials = TRIALS
+    seed = 0
+
+    i = 1
+    while i < len(sys.argv):
+        if sys.argv[i] == '-r':
+            trials = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '-s':
+            seed = int(sys.argv[i+1])
+            i += 2
+        else:
+            sys.exit(main.__doc__)
+
+    checks = [('weighted median', checkWeightedMedian),
+              ('polygon-square model', checkPolygonModel),
+              ('box list', checkBugBoxList)]
+    for (name, check) in checks:
+        sys.stderr.write('%s\n' % name)
+        check(np.random.RandomState(seed), trials)
+
+    sys.stderr.write('all checks passed\n')
+
+
+if __name__ == '__main__':
+    main()
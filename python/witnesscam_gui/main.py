@@ -23,10 +23,16 @@ import os
 from MainWindow import *
 from WitnessCam import *
 from Util import InteractionLogger
+from Profiler import PROFILER
+from Replay import ReplayEngine
+from AppData import AppData
 
 def main():
     logfile = None
     testfile = None
+    use_worker = False
+    replayfile = None
+    diagnosticsfile = None
 
     i = 0
     while i < len(sys.argv):
@@ -36,14 +42,38 @@ def main():
         elif sys.argv[i] == '-t':
             testfile = sys.argv[i+1]
             i += 2
+        elif sys.argv[i] == '-p':
+            use_worker = True
+            i += 1
+        elif sys.argv[i] == '-b':
+            replayfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-d':
+            diagnosticsfile = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '-f':
+            PROFILER.enable()
+            i += 1
         else:
             i += 1
 
     logger = InteractionLogger(logfile)
     logger.start()
     tester = TestingData.loadTestingFile(testfile)
+
+    # Replay the testing file without the gui
+    if replayfile is not None:
+        if tester is None:
+            sys.exit('A testing file is needed to replay, given with -t')
+        boxes = ReplayEngine(tester, logger, use_worker).run(diagnosticsfile)
+        boxes.writeCSV(replayfile)
+        if PROFILER.enabled:
+            PROFILER.dump(logger)
+        return
+
     app = QtGui.QApplication(sys.argv)
-    wc = WitnessCam(logger, tester)
+    wc = WitnessCam(logger, tester, use_worker,
+                    (AppData.CAM_MAX_HEIGHT, AppData.CAM_MAX_WIDTH))
     ex = MainWindow(wc, logger, tester)
 
     if tester is not None and tester.automate: